@@ -0,0 +1,193 @@
+#!/usr/bin/python -t
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Fill a FAS database with a synthetic directory for benchmarking.
+
+Never point this at a production database.  Everything it creates has a
+username or group name starting with "bench" and is deleted again by the
+next run (or by --clean), but it does write to the people, groups,
+person_roles and log tables.
+'''
+__requires__ = 'TurboGears'
+import pkg_resources
+pkg_resources.require('CherryPy >= 2.0, < 3.0alpha')
+
+import sys
+import random
+import base64
+from optparse import OptionParser
+
+parser = OptionParser(usage='%prog [options]')
+parser.add_option('-c', '--config', dest='config', default='fas.cfg',
+        help='FAS config file with the database to fill (default %default)')
+parser.add_option('-n', '--people', dest='people', type='int', default=10000,
+        help='Number of people to create (default %default)')
+parser.add_option('-g', '--groups', dest='groups', type='int', default=None,
+        help='Number of small groups to create (default people / 50)')
+parser.add_option('-s', '--seed', dest='seed', type='int', default=0,
+        help='Random seed, so runs can be repeated (default %default)')
+parser.add_option('--clean', dest='clean', action='store_true',
+        default=False, help='Only remove the generated data')
+(opts, args) = parser.parse_args()
+
+import turbogears
+turbogears.update_config(configfile=opts.config,
+        modulename='fas.config')
+from turbogears.database import get_engine
+from sqlalchemy import select
+
+from fas.model import PeopleTable, GroupsTable, PersonRolesTable, LogTable
+from fas.cache import invalidate, FAS_CLIENT
+
+# Generated rows get ids above this so they never collide with real ones
+FIRST_ID = 5000000
+BATCH_SIZE = 5000
+
+# 'bench' crypted with a fixed salt
+PASSWORD = '$1$benchsal$98J0la5BNKskrvVHxWkii0'
+
+# Groups most people are in, as (name, type, share of people in them)
+BIG_GROUPS = (
+    ('bench-packager', 'pkgdb', 0.30),
+    ('bench-fedorabugs', 'tracking', 0.25),
+    ('bench-git', 'git', 0.10),
+    ('bench-provenpackager', 'pkgdb', 0.03),
+    ('bench-sysadmin', 'system', 0.005),
+)
+SMALL_GROUP_TYPES = ('tracking', 'git', 'hg', 'svn', 'shell', 'user',
+        'bugzilla')
+
+class Inserter(object):
+    '''Insert rows into a table a batch at a time.'''
+    def __init__(self, table):
+        self.table = table
+        self.rows = []
+        self.count = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.table.insert().execute(self.rows)
+            self.count += len(self.rows)
+            self.rows = []
+
+def ssh_key(rand):
+    '''Return something shaped like an RSA public key.'''
+    return 'ssh-rsa %s bench@example.com' % base64.b64encode(
+            ('%0558x' % rand.getrandbits(279 * 8)).decode('hex'))
+
+def log_change(description):
+    '''Write a log entry so the change counter moves and caches refresh.'''
+    admin = select([PeopleTable.c.id], PeopleTable.c.username == 'admin'
+            ).execute().scalar()
+    if admin is not None:
+        LogTable.insert().execute(author_id=admin, description=description)
+    invalidate(FAS_CLIENT)
+
+def clean():
+    '''Remove everything a previous run generated.'''
+    people = select([PeopleTable.c.id],
+            PeopleTable.c.username.like('bench%'))
+    groups = select([GroupsTable.c.id], GroupsTable.c.name.like('bench%'))
+    PersonRolesTable.delete(PersonRolesTable.c.person_id.in_(people)).execute()
+    PersonRolesTable.delete(PersonRolesTable.c.group_id.in_(groups)).execute()
+    LogTable.delete(LogTable.c.author_id.in_(people)).execute()
+    GroupsTable.delete(GroupsTable.c.name.like('bench%')).execute()
+    PeopleTable.delete(PeopleTable.c.username.like('bench%')).execute()
+
+def generate(num_people, num_groups, rand):
+    '''Create people, groups and roles.
+
+    People get an ssh key 70% of the time, privacy 10% of the time and are
+    active 95% of the time.  80% have signed the CLA.  Besides the few
+    huge groups in BIG_GROUPS, small group sizes follow a Pareto
+    distribution: most have a handful of members and a few have thousands.
+    '''
+    people = Inserter(PeopleTable)
+    for number in xrange(num_people):
+        people.add({
+            'id': FIRST_ID + number,
+            'username': 'bench%07d' % number,
+            'human_name': 'Bench Person %d' % number,
+            'password': PASSWORD,
+            'email': 'bench%07d@example.com' % number,
+            'ssh_key': rand.random() < 0.7 and ssh_key(rand) or None,
+            'privacy': rand.random() < 0.1,
+            'alias_enabled': rand.random() < 0.9,
+            'status': rand.random() < 0.95 and 'active' or 'inactive',
+        })
+    people.flush()
+    person_ids = xrange(FIRST_ID, FIRST_ID + num_people)
+    owner = FIRST_ID
+
+    group_id = FIRST_ID + num_people
+    groups = Inserter(GroupsTable)
+    sizes = []
+    for name, group_type, share in BIG_GROUPS:
+        groups.add({'id': group_id, 'name': name, 'owner_id': owner,
+            'group_type': group_type, 'display_name': name})
+        sizes.append((group_id, int(num_people * share)))
+        group_id += 1
+    for number in xrange(num_groups):
+        groups.add({'id': group_id, 'name': 'bench-grp%06d' % number,
+            'owner_id': owner, 'display_name': 'Bench group %d' % number,
+            'group_type': rand.choice(SMALL_GROUP_TYPES)})
+        sizes.append((group_id,
+            min(int(rand.paretovariate(1.1)) + 1, num_people)))
+        group_id += 1
+    groups.flush()
+
+    cla_group = select([GroupsTable.c.id],
+            GroupsTable.c.name == 'cla_done').execute().scalar()
+    if cla_group is not None:
+        sizes.append((cla_group, int(num_people * 0.8)))
+
+    roles = Inserter(PersonRolesTable)
+    for group_id, size in sizes:
+        for index, person_id in enumerate(rand.sample(person_ids, size)):
+            if index == 0:
+                role_type = 'administrator'
+            elif rand.random() < 0.05:
+                role_type = 'sponsor'
+            else:
+                role_type = 'user'
+            roles.add({'person_id': person_id, 'group_id': group_id,
+                'role_type': role_type, 'sponsor_id': owner,
+                'role_status': rand.random() < 0.95 and 'approved'
+                    or 'unapproved'})
+    roles.flush()
+    return people.count, groups.count, roles.count
+
+if __name__ == '__main__':
+    get_engine()
+    clean()
+    if opts.clean:
+        log_change('bench: removed generated data')
+        sys.exit(0)
+
+    num_groups = opts.groups
+    if num_groups is None:
+        num_groups = max(opts.people / 50, 10)
+    counts = generate(opts.people, num_groups, random.Random(opts.seed))
+    log_change('bench: generated %d people' % opts.people)
+    print 'Created %d people, %d groups and %d roles' % counts
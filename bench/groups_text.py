@@ -0,0 +1,158 @@
+#!/usr/bin/python -t
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Show how fasClient's groups_text scales with the number of users.
+
+Runs groups_text on synthetic data of doubling size, with every user on the
+host as with ``@all``, and prints the time per user, which should stay
+about the same.  For the smaller sizes the output is also compared with the
+old implementation, which searched the list of users for every membership.
+
+Needs no FAS server.
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from run import CLIENT_CONFIG, load_fasclient
+
+parser = OptionParser(usage='%prog [options]')
+parser.add_option('-n', '--people', dest='people', type='int', default=10000,
+        help='Number of users to start with (default %default)')
+parser.add_option('--steps', dest='steps', type='int', default=5,
+        help='Number of times to double the number of users (default '
+        '%default)')
+parser.add_option('--check-up-to', dest='check', type='int', default=20000,
+        help='Compare with the old implementation up to this many users '
+        '(default %default)')
+
+FIRST_UID = 100000
+
+def make_data(num_people, rand):
+    '''Return users and groups in the format fasClient works with.'''
+    uids = [str(FIRST_UID + number) for number in xrange(num_people)]
+    users = {}
+    for uid in uids:
+        # Some members are inactive and so not in user_data
+        if rand.random() < 0.95:
+            users[uid] = {'username': 'bench%s' % uid}
+    groups = {}
+    sizes = [int(num_people * share) for share in (0.3, 0.25, 0.1, 0.03)]
+    sizes.extend(int(rand.paretovariate(1.1)) + 1
+            for number in xrange(num_people / 50))
+    for number, size in enumerate(sizes):
+        group = {'id': FIRST_UID + num_people + number,
+                'administrators': set(), 'sponsors': set(), 'users': set()}
+        for uid in rand.sample(uids, min(size, num_people)):
+            group[rand.choice(('administrators', 'sponsors', 'users',
+                'users'))].add(uid)
+        groups['group%06d' % number] = group
+    return users, groups
+
+def old_groups_text(fas, users):
+    '''groups_text as it was, with a linear search per membership.'''
+    i = 0
+    group_file = open(os.path.join(fas.temp, 'group.txt'), 'w')
+    groups = []
+    for uid in sorted(users.iterkeys()):
+        username = fas.users[uid]['username']
+        groups.append({'username': username, 'groups': []})
+        group_file.write('=%s %s:x:%s:\n' % (uid, username, uid))
+        group_file.write('0%i %s:x:%s:\n' % (i, username, uid))
+        group_file.write('.%s %s:x:%s:\n' % (username, username, uid))
+        i += 1
+    for groupname, group in sorted(fas.groups.iteritems()):
+        gid = group['id']
+        members = []
+        for member_uid in group['administrators'] | group['sponsors'] | \
+                group['users']:
+            username = ''
+            try:
+                username = fas.users[member_uid]['username']
+                members.append(username)
+            except KeyError:
+                pass
+            for user_groups in groups:
+                if user_groups['username'] == username:
+                    user_groups['groups'].append(str(gid))
+                    break
+        members.sort()
+        memberships = ','.join(members)
+        group_file.write('=%i %s:x:%i:%s\n' % (gid, groupname, gid, memberships))
+        group_file.write('0%i %s:x:%i:%s\n' % (i, groupname, gid, memberships))
+        group_file.write('.%s %s:x:%i:%s\n' % (groupname, groupname, gid, memberships))
+        i += 1
+    for user_groups in groups:
+        username = user_groups['username']
+        group_file.write(':%s %s %s\n' % (username, username,
+            ','.join(user_groups['groups'])))
+    group_file.close()
+
+def read_output(fas):
+    output = open(os.path.join(fas.temp, 'group.txt'))
+    try:
+        return output.read()
+    finally:
+        output.close()
+
+if __name__ == '__main__':
+    (opts, args) = parser.parse_args()
+    temp = tempfile.mkdtemp('-bench', 'fas-')
+    try:
+        config_file = os.path.join(temp, 'fas.conf')
+        config = open(config_file, 'w')
+        config.write(CLIENT_CONFIG % {'url': 'http://localhost/accounts/',
+            'temp': temp, 'username': 'bench', 'password': 'bench',
+            'groups': '@all', 'restricted_groups': ''})
+        config.close()
+        fasclient = load_fasclient(config_file)
+        fas = fasclient.MakeShellAccounts('http://localhost/accounts/',
+                username='bench', password='bench')
+
+        rand = random.Random(0)
+        failed = False
+        print '%9s %9s %12s %14s' % ('users', 'groups', 'seconds',
+                'us per user')
+        for step in xrange(opts.steps):
+            num_people = opts.people * 2 ** step
+            fas._users, fas._groups = make_data(num_people, rand)
+            users = dict((uid, {}) for uid in fas._users)
+
+            start = time.time()
+            fas.groups_text(users)
+            elapsed = time.time() - start
+            print '%9d %9d %12.3f %14.2f' % (len(users), len(fas._groups),
+                    elapsed, elapsed * 1000000 / len(users))
+
+            if num_people <= opts.check:
+                new_output = read_output(fas)
+                old_groups_text(fas, users)
+                if read_output(fas) != new_output:
+                    print '  output differs from the old implementation'
+                    failed = True
+        fas.cleanup()
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+    if failed:
+        sys.exit(1)
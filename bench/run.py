@@ -0,0 +1,238 @@
+#!/usr/bin/python -t
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Time the FAS calls and fasClient steps that grow with the size of the
+account database.
+
+Results are appended to a JSON lines file and compared with the previous
+run for the same label, so regressions stand out.
+'''
+
+import os
+import sys
+import imp
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FASCLIENT = os.path.join(BENCH_DIR, '..', 'client', 'fasClient')
+
+CLIENT_CONFIG = '''[global]
+url = %(url)s
+temp = %(temp)s
+login = %(username)s
+password = %(password)s
+prefix = %(temp)s
+modefile = %(temp)s/client_dir_perms
+cla_group = cla_done
+
+[host]
+groups = %(groups)s
+restricted_groups =
+ssh_restricted_groups = %(restricted_groups)s
+server_filter = false
+aliases_template = %(temp)s/aliases.template
+
+[users]
+shell = /bin/bash
+home = /home/fedora
+ssh_restricted_app = /usr/bin/cvs server
+restricted_shell = /sbin/nologin
+ssh_restricted_shell = /bin/bash
+ssh_key_options = no-port-forwarding,no-X11-forwarding,no-agent-forwarding,no-pty
+'''
+
+parser = OptionParser(usage='%prog [options]')
+parser.add_option('-s', '--server', dest='url',
+        default='http://localhost:8088/accounts/',
+        help='URL of the FAS server to time (default %default)')
+parser.add_option('-u', '--username', dest='username', default='admin',
+        help='Account to log in with; use one in fas-system to time what '
+        'fasClient sees (default %default)')
+parser.add_option('-p', '--password', dest='password', default='admin',
+        help='Password to log in with (default %default)')
+parser.add_option('-l', '--label', dest='label', default=None,
+        help='Name of this data set, for instance 100k.  Runs are compared '
+        'with the last one with the same label (default the number of '
+        'active people)')
+parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+        help='Number of times to run each step (default %default)')
+parser.add_option('-o', '--output', dest='output',
+        default=os.path.join(BENCH_DIR, 'results.jsonl'),
+        help='File to record results in (default %default)')
+parser.add_option('--groups', dest='groups', default='@all',
+        help='[host] groups for the fasClient steps (default %default)')
+parser.add_option('--restricted-groups', dest='restricted_groups',
+        default='@git', help='[host] ssh_restricted_groups for the fasClient '
+        'steps (default %default)')
+parser.add_option('--threshold', dest='threshold', type='float', default=10,
+        help='Percentage slowdown reported as a regression (default '
+        '%default)')
+
+def timed(repeat, function, *args, **kwargs):
+    '''Run function repeat times.
+
+    :returns: dict with the fastest and the median wall clock time
+    '''
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        function(*args, **kwargs)
+        times.append(time.time() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) / 2]}
+
+def load_fasclient(config_file):
+    '''Import client/fasClient with its command line pointing at config_file.'''
+    argv = sys.argv
+    sys.argv = ['fasClient', '-c', config_file]
+    try:
+        return imp.load_source('fasClient', FASCLIENT)
+    finally:
+        sys.argv = argv
+
+def revision():
+    '''Return the git revision being timed, if there is one.'''
+    try:
+        git = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=BENCH_DIR, stdout=subprocess.PIPE,
+                stderr=open(os.devnull, 'w'))
+        return git.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run(opts, temp):
+    config_file = os.path.join(temp, 'fas.conf')
+    config = open(config_file, 'w')
+    config.write(CLIENT_CONFIG % {'url': opts.url, 'temp': temp,
+        'username': opts.username, 'password': opts.password,
+        'groups': opts.groups, 'restricted_groups': opts.restricted_groups})
+    config.close()
+    open(os.path.join(temp, 'aliases.template'), 'w').close()
+
+    fasclient = load_fasclient(config_file)
+    fas = fasclient.MakeShellAccounts(opts.url, username=opts.username,
+            password=opts.password)
+
+    results = {}
+    def server(name, method, **params):
+        results[name] = timed(opts.repeat, fas.send_request, method,
+                req_params=params, auth=True)
+
+    server('fas_client.user_data', 'json/fas_client/user_data')
+    server('fas_client.group_data.uncached', 'json/fas_client/group_data',
+            force_refresh=True)
+    server('fas_client.group_data', 'json/fas_client/group_data')
+    server('user.list', 'user/list', search='*')
+    server('user.dump', 'user/dump', search='*')
+    server('group.list', 'group/list', search='*')
+    server('group.dump', 'group/dump')
+    server('group.view', 'group/view/bench-packager')
+
+    # fasClient's file generation, on data downloaded once
+    fas.users
+    fas.groups
+    valid_groups = opts.groups and opts.groups.split(',') or []
+    restricted_groups = opts.restricted_groups and \
+            opts.restricted_groups.split(',') or []
+    users = fas.filter_users(valid_groups=valid_groups,
+            restricted_groups=restricted_groups)
+    def filter_users():
+        # Forget what was worked out from the groups last time
+        fas._good_users = fas._group_types = None
+        fas.filter_users(valid_groups=valid_groups,
+                restricted_groups=restricted_groups)
+    results['fasClient.filter_users'] = timed(opts.repeat, filter_users)
+    results['fasClient.passwd_text'] = timed(opts.repeat, fas.passwd_text,
+            users)
+    results['fasClient.groups_text'] = timed(opts.repeat, fas.groups_text,
+            users)
+    results['fasClient.make_aliases_text'] = timed(opts.repeat,
+            fas.make_aliases_text)
+
+    return {
+        'label': opts.label or str(len(fas.users)),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': revision(),
+        'people': len(fas.users),
+        'groups': len(fas.groups),
+        'host_users': len(users),
+        'results': results,
+    }
+
+def previous_run(output, label):
+    '''Return the last recorded run with the same label.'''
+    last = None
+    try:
+        recorded = open(output)
+    except IOError:
+        return None
+    try:
+        for line in recorded:
+            if line.strip():
+                record = json.loads(line)
+                if record.get('label') == label:
+                    last = record
+    finally:
+        recorded.close()
+    return last
+
+def report(record, previous, threshold):
+    print 'Data set %(label)s: %(people)d people, %(groups)d groups, ' \
+            '%(host_users)d accounts on the fasClient host' % record
+    if previous:
+        print 'Compared with %s (%s)' % (previous['date'],
+                previous['revision'])
+    regressions = 0
+    for name in sorted(record['results']):
+        median = record['results'][name]['median']
+        line = '  %-36s %9.3fs' % (name, median)
+        if previous and name in previous['results']:
+            before = previous['results'][name]['median']
+            change = before and (median - before) * 100 / before or 0
+            line += '  %+7.1f%%' % change
+            if change > threshold:
+                line += '  REGRESSION'
+                regressions += 1
+        print line
+    return regressions
+
+if __name__ == '__main__':
+    (opts, args) = parser.parse_args()
+    temp = tempfile.mkdtemp('-bench', 'fas-')
+    try:
+        record = run(opts, temp)
+    finally:
+        shutil.rmtree(temp)
+
+    previous = previous_run(opts.output, record['label'])
+    output = open(opts.output, 'a')
+    output.write(json.dumps(record, sort_keys=True) + '\n')
+    output.close()
+
+    if report(record, previous, opts.threshold):
+        sys.exit(1)
@@ -33,9 +33,32 @@ except ImportError:
     # TG-1.0.x
     from turbogears.identity import IdentityWrapper
 
-from sqlalchemy.exc import InvalidRequestError
+from fas.model import GroupsTable, PersonRoles, role_index
 
-from fas.model import GroupsTable, PersonRoles
+def _role(person, group_name):
+    '''Look up a person's role in a group in the request's role index.
+
+    :arg person: People object or username
+    :arg group_name: Name of the group
+    :returns: (role_type, role_status) tuple or None if the person is not in
+        the group
+    '''
+    if not isinstance(person, basestring):
+        person = person.username
+    return role_index(person).get(group_name)
+
+def _approved(person, group_name, role_types=None):
+    '''Check if a person is an approved member of a group.
+
+    :arg person: People object or username
+    :arg group_name: Name of the group
+    :kwarg role_types: If given, the person must have one of these roles
+    :returns: True if the person is approved in the group otherwise False
+    '''
+    role = _role(person, group_name)
+    if not role or role[1] != 'approved':
+        return False
+    return not role_types or role[0] in role_types
 
 def is_admin(person):
     '''Checks if the user is a FAS admin.
@@ -68,22 +91,9 @@ def check_membership(person, group):
         # Save a db lookup when using an identity
         if group in person.groups:
             return True
-    elif isinstance(person, basestring):
-        # Username
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name=group).join('member'
-                            ).filter_by(username=person).one()
-            return True
-        except InvalidRequestError:
-            pass
-    else:
-        # People object
-        try:
-            if person.group_roles[group].role_status == 'approved':
-                return True
-        except KeyError:
-            pass
+    elif _approved(person, group):
+        # Username or People object
+        return True
     return False
 
 def can_admin_group(person, group, role=None):
@@ -92,37 +102,16 @@ def can_admin_group(person, group, role=None):
     :arg person: People object or username to check for admin role
     :arg group: Groups object to find out if the person is an admin for
     :kwarg role: If given, the person's role in the group.  If not given, this
-        is looked up from the db
+        is looked up in the role index of the request
     :returns: True if the person can admin this group otherwise False
     '''
     if is_admin(person):
         return True
-    if isinstance(person, basestring):
-        if group.owner.username == person:
-            return True
-        if not role:
-            try:
-                PersonRoles.query.filter_by(group=group, role_status='approved',
-                        role_type='administrator').join('member'
-                                ).filter_by(username=person).one()
-                return True
-            except InvalidRequestError:
-                # Not in the group
-                pass
-    else:
-        if group.owner.username == person:
-            return True
-        if not role:
-            try:
-                PersonRoles.query.filter_by(group=group,
-                    member=person,
-                    role_status='approved', role_type='administrator').one()
-                return True
-            except InvalidRequestError:
-                # Not in the group
-                pass
-    if role and role.role_status == 'approved' and \
-            role.role_type == 'administrator':
+    if group.owner.username == person:
+        return True
+    if not role:
+        return _approved(person, group.name, ('administrator',))
+    if role.role_status == 'approved' and role.role_type == 'administrator':
         return True
     return False
 
@@ -135,33 +124,16 @@ def can_sponsor_group(person, group):
         otherwise False
     '''
     # Check this first as it trumps the other checks
-    role = ''
     if is_admin(person):
         return True
     if isinstance(person, basestring):
         if group.owner.username == person:
             return True
-        try:
-            role = PersonRoles.query.filter_by(group=group).join('member'
-                    ).filter_by(username=person).one()
-        except InvalidRequestError:
-            # Not in the group
-            pass
     else:
         if group.owner == person:
             return True
-        try:
-            role = PersonRoles.query.filter_by(group=group,
-                member=person).one()
-        except InvalidRequestError:
-            # Not in the group
-            pass
-
-    if role and ((role.role_status == 'approved' and \
-            role.role_type == 'sponsor') or can_admin_group(person, group,
-                                                                role)):
-        return True
-    return False
+
+    return _approved(person, group.name, ('sponsor', 'administrator'))
 
 def is_approved(person, group):
     '''Check if the user is an approved member of a group.
@@ -171,21 +143,7 @@ def is_approved(person, group):
     :arg group: Group object to check if the person is an approved member of
     Returns True if the user is an approved member of a group
     '''
-    if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(group=group, role_status='approved'
-                    ).join('member').filter_by(username=person).one()
-            return True
-        except InvalidRequestError:
-            pass
-    else:
-        try:
-            if person.group_roles[group.name].role_status == 'approved':
-                return True
-        except KeyError:
-            # Not in this group
-            pass
-    return False
+    return _approved(person, group.name)
 
 def cla_done(person):
     '''Checks if the user has completed the CLA.
@@ -193,23 +151,7 @@ def cla_done(person):
     :arg person: People object or username to check for CLA status
     :returns: True if the user has completed the CLA otherwise False
     '''
-    cla_done_group = config.get('cla_done_group')
-    if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name=cla_done_group).join('member'
-                            ).filter_by(username=person).one()
-            return True
-        except InvalidRequestError:
-            # Not in the group
-            pass
-    try:
-        if person.group_roles[cla_done_group].role_status == 'approved':
-            return True
-    except KeyError:
-        # Not in the group
-        pass
-    return False
+    return _approved(person, config.get('cla_done_group'))
 
 def standard_cla_done(person):
     '''Checks if the user has completed the specific standard CLA
@@ -221,23 +163,7 @@ def standard_cla_done(person):
     :arg person: People object or username to check for CLA status
     :returns: True if the user has completed the CLA otherwise False
     '''
-    standard_cla_group = config.get('cla_standard_group')
-    if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name=standard_cla_group).join('member'
-                            ).filter_by(username=person).one()
-            return True
-        except InvalidRequestError:
-            # Not in the group
-            pass
-    try:
-        if person.group_roles[standard_cla_group].role_status == 'approved':
-            return True
-    except KeyError:
-        # Not in the group
-        pass
-    return False
+    return _approved(person, config.get('cla_standard_group'))
 
 def undeprecated_cla_done(person):
     '''Checks if the user has completed the cla.
@@ -311,27 +237,7 @@ def can_create_group(person):
     # Should groupname restrictions go here?
     if is_admin(person):
         return True
-    if isinstance(person, basestring):
-        try:
-            PersonRoles.query.filter_by(role_status='approved').join('group'
-                    ).filter_by(name='sysadmin').join('member').filter_by(
-                            username=person)
-            return True
-        except InvalidRequestError:
-            # Not in group
-            pass
-    else:
-        try:
-            # is_approved is more appropriate here, but that would require an
-            # extra group.by_name.  I need to think over the efficiency of
-            # auth.py.  Maybe something in model.py so that Any given query
-            # should only be called once...
-            if person.group_roles['sysadmin'].role_status == 'approved':
-                return True
-        except KeyError:
-            # Not in the group
-            pass
-    return False
+    return _approved(person, 'sysadmin')
 
 def can_edit_group(person, group):
     '''Check if the person can edit the group information
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Memcached helpers.
+
+Cached values live in namespaces.  Every value is stored along with the
+version its namespace had when it was built, so :func:`invalidate` makes all
+of them out of date at once just by bumping the version.  The old values age
+out of memcached on their own.
+
+Values that are expensive to build should go through :func:`get_or_build`,
+which makes sure only one request rebuilds a value at a time.
+
+Large values can be stored with :func:`set_value` and read back with
+:func:`get_value`.  They are compressed and, if still too big for a single
+memcached item, split over several keys.
+
+:class:`LRUCache` keeps small values in the process itself, for things
+looked up on every request.
+'''
+
+import math
+import time
+import random
+import zlib
+import logging
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import memcache
+import cherrypy
+from cherrypy.filters.basefilter import BaseFilter
+from turbogears import config
+
+log = logging.getLogger('fas.cache')
+
+# Namespaces
+FAS_CLIENT = 'fas_client'
+IDENTITY = 'identity'
+
+# Marks a value that was split into chunks
+_CHUNKED = '__fas_chunked__'
+# Values that pickle to fewer bytes than this are stored as they are
+COMPRESS_THRESHOLD = 16 * 1024
+
+_client = None
+
+def get_client():
+    '''Return the memcache client shared by this process.'''
+    global _client
+    if _client is None:
+        servers = config.get('memcached_server', '127.0.0.1:11211')
+        _client = memcache.Client(servers.split(','))
+    return _client
+
+def _version_key(namespace):
+    return 'fas:ns:%s' % namespace
+
+def _first_version():
+    # Start from the clock so that a version lost when memcached restarts or
+    # evicts it is never handed out again.
+    return int(time.time() * 1000)
+
+def namespace_version(namespace):
+    '''Return the current version of a namespace.
+
+    :arg namespace: Name of the namespace
+    :returns: the version number or None if memcached is unavailable
+    '''
+    mc = get_client()
+    key = _version_key(namespace)
+    version = mc.get(key)
+    if version is None:
+        mc.add(key, _first_version())
+        version = mc.get(key)
+    return version
+
+def _bump(mc, namespace):
+    key = _version_key(namespace)
+    if mc.incr(key) is None:
+        mc.add(key, _first_version())
+
+def invalidate(*namespaces):
+    '''Make every value cached in some namespaces stale.
+
+    Call this whenever something the namespaces' values are built from
+    changes.  During a request the namespaces are made stale again once it
+    is over (see :class:`InvalidateFilter`): until the changes are committed,
+    other requests can still read the old data and cache it under the new
+    version.
+
+    :arg namespaces: Names of the namespaces
+    '''
+    mc = get_client()
+    for namespace in namespaces:
+        _bump(mc, namespace)
+    try:
+        pending = getattr(cherrypy.request, 'fas_invalidated', None)
+        if pending is None:
+            pending = cherrypy.request.fas_invalidated = set()
+    except AttributeError:
+        # Not serving a request
+        return
+    pending.update(namespaces)
+
+class InvalidateFilter(BaseFilter):
+    '''Invalidate the namespaces a request invalidated once more at its end,
+    after its transaction was committed.
+    '''
+    def on_end_request(self):
+        namespaces = getattr(cherrypy.request, 'fas_invalidated', None)
+        if not namespaces:
+            return
+        mc = get_client()
+        for namespace in namespaces:
+            _bump(mc, namespace)
+
+def _chunk_size():
+    # memcached's default item size is 1MB and that has to hold the key and
+    # item header as well as the value
+    return config.get('memcached_item_size', 1024 * 1024) - 1024
+
+def set_value(key, value, expires=0):
+    '''Store a value of any size.
+
+    Values too big to store as they are get compressed.  If that is not
+    enough, the compressed value is split into chunks stored under their own
+    keys and a manifest of them is stored under ``key``.  Every store uses new
+    chunk keys, so readers never see a mix of two values.
+
+    :arg key: memcache key
+    :arg value: Anything that pickles
+    :kwarg expires: Expiry time in seconds, 0 for none
+    :returns: True if the value was stored.  Failures are logged.
+    '''
+    mc = get_client()
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) < COMPRESS_THRESHOLD:
+        stored = mc.set(key, value, expires)
+    else:
+        data = zlib.compress(data)
+        chunk_size = _chunk_size()
+        generation = '%x' % random.getrandbits(64)
+        chunks = {}
+        for number, start in enumerate(range(0, len(data), chunk_size)):
+            chunks['%s:%s:%d' % (key, generation, number)] = \
+                    data[start:start + chunk_size]
+        # Chunks first so a reader that sees the manifest finds them all
+        failed = mc.set_multi(chunks, expires)
+        stored = not failed and mc.set(key, (_CHUNKED, generation,
+            len(chunks), len(data), zlib.crc32(data)), expires)
+    if not stored:
+        log.warning('Could not store %s (%d bytes) in memcached', key,
+                len(data))
+        return False
+    return True
+
+def get_value(key):
+    '''Return a value stored with :func:`set_value`.
+
+    :arg key: memcache key
+    :returns: the value or None if it is missing or incomplete
+    '''
+    mc = get_client()
+    value = mc.get(key)
+    if not (isinstance(value, tuple) and len(value) == 5
+            and value[0] == _CHUNKED):
+        return value
+
+    generation, count, length, checksum = value[1:]
+    keys = ['%s:%s:%d' % (key, generation, number)
+            for number in range(count)]
+    chunks = mc.get_multi(keys)
+    if len(chunks) != count:
+        # Some chunks were evicted
+        return None
+    data = ''.join(chunks[chunk_key] for chunk_key in keys)
+    if len(data) != length or zlib.crc32(data) != checksum:
+        log.warning('Corrupt cached value for %s', key)
+        return None
+    return pickle.loads(zlib.decompress(data))
+
+def _is_fresh(record, version, valid):
+    return isinstance(record, tuple) and len(record) == 4 \
+            and record[0] == version and (valid is None or valid(record[1]))
+
+def get_or_build(namespace, key, build, ttl, valid=None, refresh=False,
+        lock_timeout=30, stale_ttl=3600, beta=1.0):
+    '''Return a cached value, building it if it is missing or out of date.
+
+    Only one request rebuilds a value at a time.  The others get the
+    previous value if there is one, however old, or wait for the rebuild to
+    finish.  A value is also rebuilt a little before it expires, more likely
+    the closer to expiry it is and the longer it took to build, so that
+    popular values seldom expire at all ("XFetch").
+
+    :arg namespace: Namespace the value belongs to.  :func:`invalidate`
+        makes the value out of date.
+    :arg key: Name of the value within the namespace
+    :arg build: Callable that returns the value.  The value has to pickle.
+    :arg ttl: Number of seconds the value stays up to date
+    :kwarg valid: Callable given the cached value that returns False if it is
+        out of date for some other reason
+    :kwarg refresh: Rebuild the value even if it is up to date
+    :kwarg lock_timeout: Longest time in seconds a rebuild may take before
+        another request may start one, and longest time to wait for one
+    :kwarg stale_ttl: Number of seconds an out of date value is kept to send
+        while it is rebuilt
+    :kwarg beta: Higher values rebuild earlier before expiry
+    :returns: the value.  It may be out of date if it is being rebuilt;
+        callers that care should use ``valid`` to recognise that.
+    '''
+    version = namespace_version(namespace)
+    if version is None:
+        # memcached is not available
+        return build()
+
+    mc = get_client()
+    value_key = '%s:%s' % (namespace, key)
+    record = get_value(value_key)
+    stale = None
+    if not refresh and _is_fresh(record, version, valid):
+        stale = record[1]
+        built_in, expires = record[2], record[3]
+        # The log is negative so this moves "now" forward by an
+        # exponentially distributed amount scaled by the build time
+        if time.time() - built_in * beta * math.log(1.0 - random.random()) \
+                < expires:
+            return record[1]
+    elif isinstance(record, tuple) and len(record) == 4:
+        stale = record[1]
+
+    lock_key = value_key + ':lock'
+    locked = mc.add(lock_key, 1, lock_timeout)
+    if not locked:
+        # Somebody else is rebuilding it
+        if stale is not None:
+            return stale
+        deadline = time.time() + lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.1)
+            record = get_value(value_key)
+            if _is_fresh(record, version, valid):
+                return record[1]
+            if not mc.get(lock_key):
+                break
+        # The other request failed or is taking too long.  Carry on and
+        # build it here.
+
+    try:
+        start = time.time()
+        value = build()
+        built_in = time.time() - start
+        set_value(value_key, (version, value, built_in, time.time() + ttl),
+                ttl + stale_ttl)
+    finally:
+        if locked:
+            mc.delete(lock_key)
+    return value
+
+class LRUCache(object):
+    '''Values kept in this process for a limited time.
+
+    Each value is dropped ``ttl`` seconds after it was stored.  When more than
+    ``size`` values are stored, the tenth least recently used are dropped.
+    The cache can be shared between threads.
+    '''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        # key: [value, expiry time, tick of last use]
+        self._items = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Return the value stored under key or None if there is none'''
+        self._lock.acquire()
+        try:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                del self._items[key]
+                return None
+            self._tick += 1
+            item[2] = self._tick
+            return item[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        '''Store value under key'''
+        self._lock.acquire()
+        try:
+            self._tick += 1
+            self._items[key] = [value, time.time() + self.ttl, self._tick]
+            if len(self._items) > self.size:
+                by_use = sorted(self._items.iteritems(),
+                        key=lambda item: item[1][2])
+                for old_key, item in by_use[:max(self.size / 10, 1)]:
+                    del self._items[old_key]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        '''Drop the value stored under key, if any'''
+        self._lock.acquire()
+        try:
+            self._items.pop(key, None)
+        finally:
+            self._lock.release()
@@ -45,6 +45,7 @@ from fas.model import SessionTable
 
 
 from fas.auth import undeprecated_cla_done
+from fas.cache import InvalidateFilter
 from fas.util import available_languages
 
 from fas import plugin
@@ -152,6 +153,8 @@ class Root(plugin.RootController):
         # TODO: Find a better place for this.
         os.environ['GNUPGHOME'] = config.get('gpghome')
         plugin.RootController.__init__(self)
+        # TurboGears adds its own filters to this list when it starts
+        self._cp_filters = [InvalidateFilter()]
 
     def getpluginident(self):
         return 'fas'
@@ -232,6 +235,20 @@ class Root(plugin.RootController):
                     ' reset your password below.'))
                 if request_format() != 'json':
                     redirect('/user/resetpass')
+            if request.fas_identity_failure_reason == 'throttled':
+                cherrypy.response.status = '429 Too Many Requests'
+                cherrypy.response.headers['Retry-After'] = str(
+                        config.get('throttle.window', 900))
+                turbogears.flash(_('There have been too many failed logins'
+                    ' for this account or from your address.  Please try'
+                    ' again later.'))
+            if request.fas_identity_failure_reason == 'busy':
+                # Ask clients to come back later instead of reporting a
+                # wrong password
+                cherrypy.response.status = 503
+                cherrypy.response.headers['Retry-After'] = '10'
+                turbogears.flash(_('The account system is too busy to check'
+                    ' your password right now.  Please try again in a moment.'))
             if request.fas_identity_failure_reason == 'status_account_disabled':
                 turbogears.flash(_('Your account is currently disabled.  For'
                         ' more information, please contact %(admin_email)s' %
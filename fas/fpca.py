@@ -37,9 +37,10 @@ import fas.fedmsgshim
 
 from fedora.tg.utils import request_format
 
-from fas.model import People, Groups, Log
+from fas.model import People, Groups, Log, forget_role_index
 from fas.auth import is_admin, standard_cla_done, undeprecated_cla_done
 from fas.util import send_mail
+from fas.cache import invalidate, FAS_CLIENT, IDENTITY
 import fas
 
 
@@ -169,6 +170,8 @@ class FPCA(controllers.Controller):
             for role in person.roles:
                 if self._cla_dependent(role.group):
                     role.role_status = 'unapproved'
+            invalidate(FAS_CLIENT, IDENTITY)
+            forget_role_index()
             try:
                 session.flush()
             except DBAPIError, error:
@@ -182,6 +185,10 @@ class FPCA(controllers.Controller):
             date_time = datetime.utcnow()
             Log(author_id=user.id, description='Revoked %s FPCA' %
                 person.username, changetime=date_time)
+            # Written against the person too: their groups changed, and
+            # fasClient's delta sync looks for changes by author.
+            Log(author_id=person.id, description='%s FPCA revoked by %s' %
+                (person.username, user.username), changetime=date_time)
             revoke_subject = _('Fedora ICLA Revoked', person.locale)
             i18n_revoke_text = _('''
 Hello %(human_name)s,
@@ -35,6 +35,7 @@ from turbogears.database import session
 
 import cherrypy
 import sqlalchemy
+from fedora.tg.utils import request_format
 from sqlalchemy import select, func
 from sqlalchemy.sql import and_
 from sqlalchemy.orm import eagerload
@@ -50,6 +51,9 @@ from fas.auth import can_view_group, can_create_group, can_admin_group, \
         can_edit_group, can_apply_group, can_remove_user, can_upgrade_user, \
         can_sponsor_user, can_downgrade_user, is_approved
 
+from fas.sync import change_counter, make_etag, not_modified
+from fas.cache import invalidate, FAS_CLIENT
+
 from fas.validators import UnknownGroup, KnownGroup, ValidGroupType, \
         ValidRoleSort, KnownUser
 
@@ -299,6 +303,7 @@ class Group(controllers.Controller):
             Log(author_id=person.id, description='%s created group %s' %
                 (person.username, group.name))
             session.flush()
+            invalidate(FAS_CLIENT)
         except TypeError:
             turbogears.flash(_("The group: '%s' could not be created.") % groupname)
             return dict()
@@ -378,6 +383,7 @@ class Group(controllers.Controller):
             else:
                 Log(author_id=person.id, description='%s edited group %s' %
                     (person.username, group.name))
+                invalidate(FAS_CLIENT)
                 fas.fedmsgshim.send_message(topic="group.update", msg={
                     'agent': person.username,
                     'group': group.name,
@@ -392,8 +398,18 @@ class Group(controllers.Controller):
             as_format="plain", accept_format="text/plain",
             format="text", content_type='text/plain; charset=utf-8')
     @expose(template="fas.templates.group.list", allow_json=True)
-    def list(self, search='*', with_members=True):
+    def list(self, search='*', with_members=True, if_none_match=None):
         username = turbogears.identity.current.user_name
+
+        etag = None
+        if request_format() != 'html':
+            # What a user can see depends on the groups they admin
+            etag = make_etag('group.list', request_format(), username,
+                    search, with_members, change_counter())
+            unchanged = not_modified(etag, if_none_match)
+            if unchanged is not None:
+                return unchanged
+
         person = People.by_username(username)
 
         memberships = {}
@@ -421,7 +437,8 @@ class Group(controllers.Controller):
                 groups.append(group)
         if not len(groups):
             turbogears.flash(_("No Groups found matching '%s'") % search)
-        return dict(groups=groups, search=search, memberships=memberships)
+        return dict(groups=groups, search=search, memberships=memberships,
+                etag=etag)
 
     @identity.require(turbogears.identity.not_anonymous())
     @expose(template="genshi-text:fas.templates.group.list",
@@ -771,7 +788,18 @@ into the e-mail aliases within an hour.
     @expose(template="genshi-text:fas.templates.group.dump", format="text",
             content_type='text/plain; charset=utf-8')
     @expose(allow_json=True)
-    def dump(self, groupname=None, role_type=None):
+    def dump(self, groupname=None, role_type=None, if_none_match=None):
+        # The email addresses sent depend on who is asking
+        if identity.current.anonymous:
+            requester = None
+        else:
+            requester = identity.current.user_name
+        etag = make_etag('group.dump', request_format(), requester,
+                groupname, role_type, change_counter())
+        unchanged = not_modified(etag, if_none_match)
+        if unchanged is not None:
+            return unchanged
+
         if not groupname:
             stmt = select([People.privacy, People.username, People.email,
                 People.human_name, "'user'", 's.sponsored'],
@@ -814,7 +842,7 @@ into the e-mail aliases within an hour.
                 # filter private data
                 person[2] = u''
             people.append(person)
-        return dict(people=people)
+        return dict(people=people, etag=etag)
 
     @identity.require(identity.not_anonymous())
     @validate(validators=GroupInvite())
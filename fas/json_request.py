@@ -22,10 +22,17 @@
 #
 import turbogears
 from turbogears import controllers, expose, identity, config
+import cherrypy
+import base64
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 from sqlalchemy.exc import InvalidRequestError
 import sqlalchemy
-from sqlalchemy import select
+from sqlalchemy import select, and_
 
 from fas.model import People
 from fas.model import Groups
@@ -33,13 +40,341 @@ from fas.model import PersonRoles
 from fas.model import PeopleTable
 from fas.model import GroupsTable
 from fas.model import PersonRolesTable
-
-import memcache
-
-# TODO: Should this code be put somewhere else?
-memcached_servers = config.get('memcached_server').split(',')
-# Setup our memcache client
-mc = memcache.Client(memcached_servers)
+from fas.sync import current_token, parse_token, changed_since, \
+        approved_roles, make_etag, not_modified
+from fas.snapshot import snapshots_enabled, open_snapshot, serve_snapshot
+
+from fas.cache import FAS_CLIENT, get_or_build
+from fas.auth import is_admin
+from fas import throttle
+
+def _client_privs():
+    '''Return which private fields the current identity may see.'''
+    admin_group = config.get('admingroup', 'accounts')
+    system_group = config.get('systemgroup', 'fas-system')
+    thirdparty_group = config.get('thirdpartygroup', 'thirdparty')
+
+    privs = {
+        'admin': False,
+        'system': False,
+        'thirdparty': False,
+    }
+
+    if identity.in_group(admin_group):
+        privs['admin'] = privs['system'] = privs['thirdparty'] = True
+    elif identity.in_group(system_group):
+        privs['system'] = privs['thirdparty'] = True
+    elif identity.in_group(thirdparty_group):
+        privs['thirdparty'] = True
+    return privs
+
+def _privs_tier(privs):
+    '''Name the variant of user_data that privs get to see.'''
+    if privs['system']:
+        return 'system'
+    elif privs['thirdparty']:
+        return 'thirdparty'
+    return 'public'
+
+def _group_list():
+    '''Return the id and type of every group, keyed by group name.'''
+    groups = {}
+    results = select([GroupsTable.c.id, GroupsTable.c.name,
+        GroupsTable.c.group_type]).execute()
+    for id, name, group_type in results:
+        groups[name] = {'id': id, 'type': group_type}
+    return groups
+
+def _group_data():
+    '''Return every group with the ids of its approved members.'''
+    groups = {}
+    groupjoin = [GroupsTable.outerjoin(PersonRolesTable,
+        PersonRolesTable.c.group_id == GroupsTable.c.id)]
+
+    group_query = select([GroupsTable.c.id, GroupsTable.c.name,
+        GroupsTable.c.group_type, PersonRolesTable.c.person_id,
+        PersonRolesTable.c.role_status, PersonRolesTable.c.role_type],
+        from_obj=groupjoin)
+
+    results = group_query.execute()
+
+    for id, name, group_type, person_id, role_status, role_type in results:
+        if name not in groups:
+            groups[name] = {
+                'id': id,
+                'administrators': [],
+                'sponsors': [],
+                'users': [],
+                'type': group_type
+            }
+
+        if role_status != 'approved':
+            continue
+
+        if role_type == 'administrator':
+            groups[name]['administrators'].append(person_id)
+        elif role_type == 'sponsor':
+            groups[name]['sponsors'].append(person_id)
+        elif role_type == 'user':
+            groups[name]['users'].append(person_id)
+    return groups
+
+def _encode_ids(ids):
+    '''Pack a list of ids into a short string.
+
+    The ids are sorted and the differences between them written as base 128
+    varints (seven bits per byte, high bit set on all but the last byte of a
+    number) and then base64 encoded.
+
+    :arg ids: iterable of non-negative integers
+    :returns: ASCII string
+    '''
+    packed = []
+    previous = 0
+    for id in sorted(ids):
+        delta = id - previous
+        previous = id
+        while delta > 0x7f:
+            packed.append(chr(delta & 0x7f | 0x80))
+            delta >>= 7
+        packed.append(chr(delta))
+    return base64.b64encode(''.join(packed))
+
+def _compact_group_data(groups):
+    '''Return group data with the member lists packed by :func:`_encode_ids`.'''
+    compact = {}
+    for name, group in groups.iteritems():
+        compact[name] = {
+            'id': group['id'],
+            'type': group['type'],
+            'administrators': _encode_ids(group['administrators']),
+            'sponsors': _encode_ids(group['sponsors']),
+            'users': _encode_ids(group['users']),
+        }
+    return compact
+
+def _cached_group_data(token, refresh=False, compact=False):
+    '''Return :func:`_group_data` from memcached, building it if needed.
+
+    :arg token: Sync token taken before the call
+    :kwarg refresh: Rebuild it even if the cached copy is up to date
+    :kwarg compact: Return it as :func:`_compact_group_data` does
+    :returns: tuple of the sync token the data was read with and the data.
+        The data can be newer than ``token``, or older if another request is
+        busy rebuilding it.
+    '''
+    counter = parse_token(token)[0]
+    # A request that read the database before a write was committed could
+    # have stored old data after the write invalidated the cache, so also
+    # check the change counter.  Data read after the counter the request
+    # started with is as good, and rebuilding it would throw away newer data
+    # while writes are frequent.
+    if compact:
+        return get_or_build(FAS_CLIENT, 'group_data-compact',
+                lambda: (token, _compact_group_data(_group_data())),
+                config.get('fas_client.group_data_ttl', 6 * 60 * 60),
+                valid=lambda cached: parse_token(cached[0])[0] >= counter,
+                refresh=refresh)
+    return get_or_build(FAS_CLIENT, 'group_data',
+            lambda: (token, _group_data()),
+            config.get('fas_client.group_data_ttl', 6 * 60 * 60),
+            valid=lambda cached: parse_token(cached[0])[0] >= counter,
+            refresh=refresh)
+
+def _host_access(groups, valid_groups, restricted_groups, cla_group):
+    '''Work out who gets an account on a host, the same way fasClient does.
+
+    :arg groups: dict from :func:`_group_data`
+    :arg valid_groups: Groups whose members get a full account.  ``@type``
+        stands for every group of that type and ``@all`` for everyone in
+        cla_group and at least one other group.
+    :arg restricted_groups: Groups whose members get a restricted account,
+        in the same format.  A full account wins over a restricted one.
+    :arg cla_group: Name of the group of people that signed the CLA
+    :returns: tuple of a dict mapping person ids to True for a full account
+        and False for a restricted one, and a list of the groups and group
+        types that do not exist
+    '''
+    selected = {}
+    unknown = []
+    for selector in valid_groups + restricted_groups:
+        if selector in selected or selector in unknown:
+            continue
+        if not selector.startswith('@'):
+            if selector in groups:
+                group = groups[selector]
+                selected[selector] = set(group['users'] + group['sponsors']
+                        + group['administrators'])
+            else:
+                unknown.append(selector)
+            continue
+
+        group_type = selector[1:]
+        members = set()
+        others = set()
+        for name, group in groups.iteritems():
+            if name.startswith('cla_'):
+                continue
+            group_members = group['users'] + group['sponsors'] + \
+                    group['administrators']
+            if group_type == 'all':
+                others.update(group_members)
+            elif group['type'] == group_type:
+                members.update(group_members)
+        if group_type == 'all':
+            if cla_group not in groups:
+                unknown.append(cla_group)
+                continue
+            cla = groups[cla_group]
+            members = others.intersection(cla['users'] + cla['sponsors'] +
+                    cla['administrators'])
+        elif not members:
+            unknown.append(selector)
+            continue
+        selected[selector] = members
+
+    access = {}
+    for selector in restricted_groups:
+        for person_id in selected.get(selector, ()):
+            access[person_id] = False
+    for selector in valid_groups:
+        for person_id in selected.get(selector, ()):
+            access[person_id] = True
+    return access, unknown
+
+def _host_groups(groups, person_ids):
+    '''Cut group data down to the members a host needs.
+
+    Every group is kept, as fasClient writes them all to /etc/group whether
+    or not anyone on the host is in them.
+
+    :arg groups: dict from :func:`_group_data`
+    :arg person_ids: People that have an account on the host
+    :returns: dict in the same format listing only the members that are in
+        person_ids
+    '''
+    host_groups = {}
+    for name, group in groups.iteritems():
+        members = {'id': group['id'], 'type': group['type']}
+        for role_type in ('administrators', 'sponsors', 'users'):
+            members[role_type] = [person_id for person_id in group[role_type]
+                    if person_id in person_ids]
+        host_groups[name] = members
+    return host_groups
+
+def _user_data_query(constraint=None):
+    '''Return the query for the account information of active people.
+
+    :kwarg constraint: Extra where clause limiting the people returned
+    '''
+    where = PeopleTable.c.status == 'active'
+    if constraint is not None:
+        where = and_(where, constraint)
+    return select([
+        PeopleTable.c.id,
+        PeopleTable.c.username,
+        PeopleTable.c.password,
+        PeopleTable.c.human_name,
+        PeopleTable.c.ssh_key,
+        PeopleTable.c.email,
+        PeopleTable.c.privacy,
+        PeopleTable.c.alias_enabled
+        ], where)
+
+def _format_person(row, privs):
+    '''Turn a row from :func:`_user_data_query` into fasClient's format.
+
+    :returns: tuple of (person id, dict of account information)
+    '''
+    id, username, password, human_name, ssh_key, email, privacy, alias_enabled = row
+    person = {
+        'username': username,
+        'password': password,
+        'human_name': human_name,
+        'ssh_key': ssh_key,
+        'email': email,
+        'alias_enabled': alias_enabled
+    }
+
+    if privacy:
+        # If they have privacy enabled, set their human_name to
+        # their username
+        person['human_name'] = username
+
+    if not privs['system']:
+        person['password'] = '*'
+    if not privs['thirdparty']:
+        person['ssh_key'] = ''
+    return (id, person)
+
+def _user_data(privs, constraint=None):
+    '''Return the account information of active people, keyed by id.
+
+    :arg privs: dict from :func:`_client_privs`
+    :kwarg constraint: Extra where clause limiting the people returned
+    '''
+    return dict(_format_person(row, privs)
+            for row in _user_data_query(constraint).execute())
+
+def _user_data_batches(batch_size):
+    '''Yield the rows of :func:`_user_data_query` a batch at a time.
+
+    The database driver is kept from buffering the whole result: with
+    SQLAlchemy 0.6 and later by a server side cursor, before that by paging
+    through people in id order, one query per batch.
+    '''
+    query = _user_data_query()
+    if hasattr(query, 'execution_options'):
+        results = query.execution_options(stream_results=True).execute()
+        try:
+            while True:
+                rows = results.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            results.close()
+        return
+
+    last_id = None
+    while True:
+        if last_id is None:
+            query = _user_data_query()
+        else:
+            query = _user_data_query(PeopleTable.c.id > last_id)
+        rows = query.order_by(PeopleTable.c.id).limit(batch_size
+                ).execute().fetchall()
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            break
+        last_id = rows[-1][0]
+
+def _iter_user_data(privs, **extra):
+    '''Yield the full user_data response as JSON, a batch at a time.
+
+    This produces the same document TurboGears would for the dict that
+    :meth:`JsonRequest.fas_client` returns but never holds more than one batch
+    of people in memory, however many accounts there are.
+
+    :arg privs: dict from :func:`_client_privs`
+    :kwarg extra: Other values to send alongside ``data``
+    '''
+    batch_size = config.get('fas_client.stream_batch_size', 1000)
+
+    header = dict(success=True, full=True, tg_flash=None)
+    header.update(extra)
+    # Leave the closing brace off so data can follow
+    yield '%s, "data": {' % json.dumps(header)[:-1]
+    separator = ''
+    for rows in _user_data_batches(batch_size):
+        chunk = []
+        for row in rows:
+            id, person = _format_person(row, privs)
+            chunk.append('%s"%d": %s' % (separator, id, json.dumps(person)))
+            separator = ', '
+        yield ''.join(chunk)
+    yield '}}'
 
 class JsonRequest(controllers.Controller):
     def __init__(self):
@@ -65,97 +400,162 @@ class JsonRequest(controllers.Controller):
 
     @identity.require(turbogears.identity.not_anonymous())
     @expose("json", allow_json=True)
-    def fas_client(self, data=None, force_refresh=None):
-        admin_group = config.get('admingroup', 'accounts')
-        system_group = config.get('systemgroup', 'fas-system')
-        thirdparty_group = config.get('thirdpartygroup', 'thirdparty')
-
-        privs = {
-            'admin': False,
-            'system': False,
-            'thirdparty': False,
-        }
-
-        if identity.in_group(admin_group):
-            privs['admin'] = privs['system'] = privs['thirdparty'] = True
-        elif identity.in_group(system_group):
-            privs['system'] = privs['thirdparty'] = True
-        elif identity.in_group(thirdparty_group):
-            privs['thirdparty'] = True
+    def fas_client(self, data=None, force_refresh=None, since=None,
+            if_none_match=None, encoding=None):
+        '''Return the data fasClient needs to build a host's accounts.
+
+        :kwarg data: Either 'group_data' or 'user_data'
+        :kwarg force_refresh: If set, do not use the cached group_data.  This
+            should not be needed since changes invalidate the cache.
+        :kwarg since: A sync token from a previous call.  If given and the
+            token is not too old, only the people and roles that changed
+            since the token was issued are returned and ``full`` is False.
+        :kwarg if_none_match: The ``etag`` of a previous full response.  If
+            nothing changed since, only ``not_modified`` is returned.  HTTP
+            clients can send an If-None-Match header instead.
+        :kwarg encoding: If 'compact', full group_data has each list of
+            member ids packed into a string (see :func:`_encode_ids`)
+        :returns: dict with ``data``, the ``token`` to send as ``since`` on
+            the next call and whether ``data`` is a ``full`` snapshot.  Delta
+            user_data also has the ids of the people that were ``removed``;
+            delta group_data has the current group list in ``data`` (without
+            members) and the complete approved ``roles`` of the people that
+            changed.  Full snapshots also carry their ``etag``.
+        '''
+        if data not in ('group_data', 'user_data'):
+            return dict(success=False, data={})
+        compact = data == 'group_data' and encoding == 'compact'
+
+        privs = _client_privs()
+
+        # Taken before anything is read so that changes made meanwhile are
+        # sent again with the next request.
+        token = current_token()
+
+        if since:
+            changed = changed_since(since)
+            if changed is not None and data == 'group_data':
+                return dict(success=True, full=False, token=token,
+                        data=_group_list(), roles=approved_roles(changed))
+            elif changed is not None:
+                people = {}
+                if changed:
+                    people = _user_data(privs, PeopleTable.c.id.in_(changed))
+                removed = [person_id for person_id in changed
+                        if person_id not in people]
+                return dict(success=True, full=False, token=token,
+                        data=people, removed=removed)
+
+        counter = parse_token(token)[0]
+        if data == 'group_data':
+            etag = make_etag('fas_client', data, encoding, counter)
+        else:
+            etag = make_etag('fas_client', data, _privs_tier(privs), counter)
+        unchanged = not_modified(etag, if_none_match)
+        if unchanged is not None:
+            return unchanged
+
+        if snapshots_enabled():
+            # Every host with the same privileges gets the same bytes, so
+            # encode them once per change instead of once per request.
+            if compact:
+                name = 'group_data-compact'
+                build = lambda: [json.dumps(dict(success=True, full=True,
+                    tg_flash=None, token=token, etag=etag,
+                    data=_compact_group_data(_group_data())))]
+            elif data == 'group_data':
+                name = 'group_data'
+                build = lambda: [json.dumps(dict(success=True, full=True,
+                    tg_flash=None, token=token, etag=etag,
+                    data=_group_data()))]
+            else:
+                name = 'user_data-%s' % _privs_tier(privs)
+                build = lambda: _iter_user_data(privs, token=token, etag=etag)
+            return serve_snapshot(open_snapshot(name, counter, build))
 
         if data == 'group_data':
-            groups = None
-            if not force_refresh:
-                groups = mc.get('group_data')
-            if not groups:
-                groups = {}
-                groupjoin = [GroupsTable.outerjoin(PersonRolesTable,
-                    PersonRolesTable.c.group_id == GroupsTable.c.id)]
-
-                group_query = select([GroupsTable.c.id, GroupsTable.c.name,
-                    GroupsTable.c.group_type, PersonRolesTable.c.person_id,
-                    PersonRolesTable.c.role_status, PersonRolesTable.c.role_type],
-                    from_obj=groupjoin)
-
-                results = group_query.execute()
-
-                for id, name, group_type, person_id, role_status, role_type in results:
-                    if name not in groups:
-                        groups[name] = {
-                            'id': id,
-                            'administrators': [],
-                            'sponsors': [],
-                            'users': [],
-                            'type': group_type
-                        }
-
-                    if role_status != 'approved':
-                        continue
-
-                    if role_type == 'administrator':
-                        groups[name]['administrators'].append(person_id)
-                    elif role_type == 'sponsor':
-                        groups[name]['sponsors'].append(person_id)
-                    elif role_type == 'user':
-                        groups[name]['users'].append(person_id)
-
-                # Save cache - valid for 15 minutes
-                mc.set('group_data', groups, 900)
-
-            return dict(success=True, data=groups)
-        elif data == 'user_data':
-            people = {}
-            people_list = select([
-                PeopleTable.c.id,
-                PeopleTable.c.username,
-                PeopleTable.c.password,
-                PeopleTable.c.human_name,
-                PeopleTable.c.ssh_key,
-                PeopleTable.c.email,
-                PeopleTable.c.privacy,
-                PeopleTable.c.alias_enabled
-                ], PeopleTable.c.status == 'active').execute()
-            for id, username, password, human_name, ssh_key, email, privacy, alias_enabled in people_list:
-                people[id] = {
-                    'username': username,
-                    'password': password,
-                    'human_name': human_name,
-                    'ssh_key': ssh_key,
-                    'email': email,
-                    'alias_enabled': alias_enabled
-                }
-
-                if privacy:
-                    # If they have privacy enabled, set their human_name to
-                    # their username
-                    people[id]['human_name'] = username
-
-                if not privs['system']:
-                    people[id]['password'] = '*'
-                if not privs['thirdparty']:
-                    people[id]['ssh_key'] = ''
-            return dict(success=True, data=people)
-        return dict(success=False, data={})
+            cached_token, groups = _cached_group_data(token, force_refresh,
+                    compact)
+            cached_counter = parse_token(cached_token)[0]
+            if cached_counter != counter:
+                # We got a newer copy, or the previous one while another
+                # request rebuilds it.  Tag it as what it is so the client
+                # asks again when there is something newer still.
+                etag = make_etag('fas_client', data, encoding, cached_counter)
+                cherrypy.response.headers['ETag'] = etag
+            token = cached_token
+
+            return dict(success=True, full=True, token=token, etag=etag,
+                    data=groups)
+        else:
+            if config.get('fas_client.stream_user_data', True):
+                # Returning anything but a dict bypasses TurboGears' json
+                # template so the response is written as it is generated.
+                cherrypy.response.headers['Content-Type'] = \
+                        'application/json; charset=utf-8'
+                return _iter_user_data(privs, token=token, etag=etag)
+            return dict(success=True, full=True, token=token, etag=etag,
+                    data=_user_data(privs))
+
+    @identity.require(turbogears.identity.not_anonymous())
+    @expose("json", allow_json=True)
+    def fas_client_host(self, groups='', restricted_groups='',
+            cla_group='cla_done', if_none_match=None):
+        '''Return only the data fasClient needs for one host.
+
+        :kwarg groups: Comma separated groups whose members get a full account
+            on the host.  ``@type`` selects every group of that type and
+            ``@all`` everyone in cla_group and one other group.
+        :kwarg restricted_groups: Comma separated groups whose members get a
+            restricted account, in the same format
+        :kwarg cla_group: Group of people that signed the CLA, for ``@all``
+        :kwarg if_none_match: The ``etag`` of a previous response.  If nothing
+            changed since, only ``not_modified`` is returned.
+        :returns: dict with the host's ``etag`` and ``data`` holding the
+            ``users`` with an account and every group with only those users
+            as members, in the same format as fas_client, the ids of the users that only get a
+            ``restricted`` account and the groups and group types that are
+            ``unknown``
+        '''
+        valid_groups = [group.strip() for group in groups.split(',')
+                if group.strip()]
+        restricted_groups = [group.strip()
+                for group in restricted_groups.split(',') if group.strip()]
+        privs = _client_privs()
+
+        token = current_token()
+        counter = parse_token(token)[0]
+        etag = make_etag('fas_client_host', _privs_tier(privs),
+                ','.join(valid_groups), ','.join(restricted_groups),
+                cla_group, counter)
+        unchanged = not_modified(etag, if_none_match)
+        if unchanged is not None:
+            return unchanged
+
+        cached_token, group_data = _cached_group_data(token)
+        cached_counter = parse_token(cached_token)[0]
+        if cached_counter != counter:
+            # Same as in fas_client: send the old copy with its own tag
+            etag = make_etag('fas_client_host', _privs_tier(privs),
+                    ','.join(valid_groups), ','.join(restricted_groups),
+                    cla_group, cached_counter)
+            cherrypy.response.headers['ETag'] = etag
+
+        access, unknown = _host_access(group_data, valid_groups,
+                restricted_groups, cla_group)
+        users = {}
+        if access:
+            # Inactive people are left out here
+            users = _user_data(privs, PeopleTable.c.id.in_(access.keys()))
+        restricted = [person_id for person_id in users
+                if not access[person_id]]
+        host_data = {
+            'users': users,
+            'groups': _host_groups(group_data, users),
+            'restricted': restricted,
+            'unknown': unknown,
+        }
+        return dict(success=True, etag=etag, data=host_data)
 
     @identity.require(turbogears.identity.not_anonymous())
     @expose("json", allow_json=True)
@@ -261,3 +661,19 @@ class JsonRequest(controllers.Controller):
 
         results = [dict(zip(cols, r)) for r in query.execute()]
         return dict(success=True, data=results)
+
+    @identity.require(turbogears.identity.not_anonymous())
+    @expose("json", allow_json=True)
+    def throttled(self):
+        '''List the usernames and addresses whose logins are turned down.
+
+        Only available to FAS admins.
+        '''
+        if not is_admin(identity.current):
+            return dict(success=False, error='Only admins may see this.')
+        throttled = throttle.throttled()
+        for user in throttled['users'].itervalues():
+            if user['last_failure']:
+                user['last_failure'] = user['last_failure'].isoformat()
+        return dict(success=True, users=throttled['users'],
+                ips=throttled['ips'])
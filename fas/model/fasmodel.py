@@ -31,6 +31,7 @@ import pytz
 from turbogears.database import metadata, mapper, get_engine, session
 from turbogears import identity, config
 import turbogears
+import cherrypy
 
 from sqlalchemy import Table, Column, ForeignKey, Sequence
 from sqlalchemy import String, Integer, DateTime, Boolean
@@ -48,6 +49,7 @@ from fedora.client import DictContainer
 from fedora.tg.json import SABase
 import fas
 from fas import SHARE_CC_GROUP, SHARE_LOC_GROUP
+from fas.cache import invalidate, FAS_CLIENT, IDENTITY
 
 # Bind us to the database defined in the config file.
 get_engine()
@@ -194,6 +196,8 @@ class People(SABase):
             role.role_type = 'user'
             role.member = cls
             role.group = group
+            invalidate(FAS_CLIENT, IDENTITY)
+            forget_role_index()
 
     def upgrade(cls, group, requester):
         '''
@@ -209,6 +213,8 @@ class People(SABase):
                 role.role_type = 'administrator'
             elif role.role_type == 'user':
                 role.role_type = 'sponsor'
+            invalidate(FAS_CLIENT, IDENTITY)
+            forget_role_index()
 
     def downgrade(cls, group, requester):
         '''
@@ -224,6 +230,8 @@ class People(SABase):
                 role.role_type = 'user'
             elif role.role_type == 'administrator':
                 role.role_type = 'sponsor'
+            invalidate(FAS_CLIENT, IDENTITY)
+            forget_role_index()
 
     def sponsor(cls, group, requester):
         # If we want to do logging, this might be the place.
@@ -233,6 +241,8 @@ class People(SABase):
         role.role_status = 'approved'
         role.sponsor = requester
         role.approval = datetime.now(pytz.utc)
+        invalidate(FAS_CLIENT, IDENTITY)
+        forget_role_index()
         cls._handle_auto_add(group, requester)
 
     def _handle_auto_add(cls, group, requester):
@@ -268,6 +278,8 @@ class People(SABase):
             role.sponsor = requester
             role.role_status = 'approved'
             role.approval = datetime.now(pytz.utc)
+        invalidate(FAS_CLIENT, IDENTITY)
+        forget_role_index()
 
     def remove(cls, group, requester):
         if not group in cls.memberships:
@@ -275,6 +287,8 @@ class People(SABase):
         else:
             role = PersonRoles.query.filter_by(member=cls, group=group).one()
             session.delete(role)
+            invalidate(FAS_CLIENT, IDENTITY)
+            forget_role_index()
 
     def set_share_cc(self, value):
         share_cc_group = Groups.by_name(SHARE_CC_GROUP)
@@ -438,6 +452,8 @@ class Groups(SABase):
         for role in cls.roles:
             session.delete(role)
         session.delete(cls)
+        invalidate(FAS_CLIENT, IDENTITY)
+        forget_role_index()
 
     def __repr__(cls):
         return "Groups(%s,%s)" % (cls.name, cls.display_name)
@@ -604,3 +620,35 @@ mapper(Log, LogTable)
 mapper(Visit, visits_table)
 mapper(VisitIdentity, visit_identity_table,
         properties=dict(users=relation(People, backref='visit_identity')))
+
+#
+# Roles of people, kept for the length of a request
+#
+
+def role_index(username):
+    '''Return the roles of a person in all their groups.
+
+    The roles are loaded with a single query the first time they are needed
+    in a request and kept until the request ends or :func:`forget_role_index`
+    is called.
+
+    :arg username: Username of the person
+    :returns: dict mapping group names to a (role_type, role_status) tuple
+    '''
+    index = getattr(cherrypy.request, 'fas_role_index', None)
+    if index is None:
+        index = cherrypy.request.fas_role_index = {}
+    if username not in index:
+        roles = {}
+        for role in PersonRoles.query.join('member').filter_by(
+                username=username):
+            roles[role.group.name] = (role.role_type, role.role_status)
+        index[username] = roles
+    return index[username]
+
+def forget_role_index():
+    '''Make :func:`role_index` load roles again.
+
+    Call this whenever a role is added, changed or removed.
+    '''
+    cherrypy.request.fas_role_index = {}
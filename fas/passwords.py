@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Password hashing off the request threads.
+
+crypt() with a strong hash keeps a CPU busy for a while, and a lot of logins
+at once would otherwise tie up every CherryPy thread.  :func:`check_password`
+and :func:`new_hash` run crypt() in a small pool of worker processes
+instead.  Only ``password.queue_size`` calls may be running or waiting at a
+time; past that they raise :exc:`PasswordCheckBusy` straight away so the
+request can be turned down rather than queued behind the others.  A call
+that gives up waiting after ``password.timeout`` seconds keeps its place in
+the queue until its worker is done with it, or until
+``password.hard_timeout`` seconds have passed: the pool never reports on
+work whose worker died, so its place would be lost for good.
+
+Without the multiprocessing module (python < 2.6) or with
+``password.workers = 0``, crypt() runs in the calling thread, still limited
+by the queue size.
+'''
+
+import time
+import crypt
+import string
+import logging
+import itertools
+import threading
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from turbogears import config
+
+if config.get('use_openssl_rand_bytes', False):
+    from OpenSSL.rand import bytes as rand_bytes
+else:
+    from os import urandom as rand_bytes
+
+log = logging.getLogger('fas.passwords')
+
+# crypt(3) hash ids, as in $6$salt$hash
+SHA512 = '6'
+SHA256 = '5'
+# Hashes converted from the old account system
+LEGACY_PREFIX = '$1$'
+
+SALT_CHARS = string.ascii_letters + string.digits + './'
+
+_pool = None
+_slots = None
+_setup_lock = threading.Lock()
+
+# Work handed to the pool, task number: time it was handed over
+_outstanding = {}
+_task_numbers = itertools.count()
+_tasks_lock = threading.Lock()
+
+class PasswordCheckBusy(Exception):
+    '''Too many passwords are being checked already.'''
+    pass
+
+def random_string(charset, length):
+    '''Generates a random string for password and salts.
+
+    This use a pseudo-random number generator suitable for cryptographic
+    use, such as /dev/urandom or (better) OpenSSL's RAND_bytes.
+
+    :arg length: Length of salt to be generated
+    :returns: String of salt
+    '''
+    s = ''
+
+    while length > 0:
+        r = rand_bytes(length)
+        for c in r:
+            # Discard all bytes that aren't in the charset.  This is the
+            # simplest way to ensure that the function is not biased.
+            if c in charset:
+                s += c
+                length -= 1
+
+    return s
+
+def make_salt():
+    '''Return a new crypt(3) salt for the scheme set by ``password.scheme``.
+    '''
+    return '$%s$%s' % (config.get('password.scheme', SHA512),
+            random_string(SALT_CHARS, 16))
+
+def _crypt(password, salt):
+    try:
+        return crypt.crypt(password, salt)
+    except Exception:
+        # The pool only calls back with results, so never raise: the slot
+        # would never be given back
+        return None
+
+def _finished(task):
+    '''Give back the slot of a task, unless it was reclaimed already.'''
+    _tasks_lock.acquire()
+    try:
+        if _outstanding.pop(task, None) is None:
+            return
+    finally:
+        _tasks_lock.release()
+    _slots.release()
+
+def _reclaim():
+    '''Give back the slots of tasks running for longer than
+    ``password.hard_timeout`` seconds.
+
+    The pool replaces workers that die, but never calls back for the task
+    they were running.
+    '''
+    limit = time.time() - config.get('password.hard_timeout', 60)
+    _tasks_lock.acquire()
+    try:
+        late = [task for task, started in _outstanding.iteritems()
+                if started < limit]
+        for task in late:
+            del _outstanding[task]
+    finally:
+        _tasks_lock.release()
+    if late:
+        log.error('Giving up on %i password checks that never finished',
+                len(late))
+    for task in late:
+        _slots.release()
+
+def setup():
+    '''Start the worker processes.
+
+    Best called before the server starts its threads, since forking a
+    process that has them running is asking for trouble.  Calling it again
+    does nothing.
+    '''
+    global _pool, _slots
+    _setup_lock.acquire()
+    try:
+        if _slots is not None:
+            return
+        workers = config.get('password.workers', 4)
+        if workers and multiprocessing:
+            _pool = multiprocessing.Pool(workers)
+        _slots = threading.BoundedSemaphore(
+                config.get('password.queue_size', 20))
+    finally:
+        _setup_lock.release()
+
+def _run(password, salt):
+    '''crypt() password in the pool, or here if there is none.
+
+    :raises PasswordCheckBusy: if the queue is full
+    '''
+    if _slots is None:
+        setup()
+    if not _slots.acquire(False):
+        if not _pool:
+            raise PasswordCheckBusy()
+        _reclaim()
+        if not _slots.acquire(False):
+            raise PasswordCheckBusy()
+    if not _pool:
+        try:
+            return _crypt(password, salt)
+        finally:
+            _slots.release()
+    # The slot is given back when the worker is done, not when we stop
+    # waiting for it, so checks that take too long still count against the
+    # queue size until they end.
+    task = _task_numbers.next()
+    _tasks_lock.acquire()
+    try:
+        _outstanding[task] = time.time()
+    finally:
+        _tasks_lock.release()
+    try:
+        result = _pool.apply_async(_crypt, (password, salt),
+                callback=lambda hashed: _finished(task))
+    except:
+        _finished(task)
+        raise
+    try:
+        return result.get(config.get('password.timeout', 10))
+    except multiprocessing.TimeoutError:
+        log.warning('Gave up waiting for a password worker')
+        _reclaim()
+        raise PasswordCheckBusy()
+
+def check_password(password, hashed):
+    '''Tell whether password matches the crypted hashed.
+
+    :arg password: plain text password as given by the user
+    :arg hashed: crypted password from the database
+    :returns: True if they match
+    :raises PasswordCheckBusy: if too many checks are running already
+    '''
+    # crypt.crypt(stuff, '') == ''
+    if not password or not hashed:
+        return False
+    return _run(password.encode('utf-8'), hashed) == hashed
+
+def new_hash(password):
+    '''Crypt password with the scheme set by ``password.scheme``.
+
+    :arg password: plain text password
+    :returns: the crypted password
+    :raises PasswordCheckBusy: if too many checks are running already
+    '''
+    hashed = _run(password.encode('utf-8'), make_salt())
+    if not hashed:
+        raise ValueError('crypt() could not hash the password')
+    return hashed
+
+def needs_rehash(hashed):
+    '''Tell whether hashed uses a legacy scheme that should be replaced.
+
+    Rehashing can be turned off with ``password.rehash = False``.
+    '''
+    return config.get('password.rehash', True) and \
+            hashed.startswith(LEGACY_PREFIX)
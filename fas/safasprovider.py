@@ -24,19 +24,25 @@ This plugin provides authentication of passwords against the Fedora Account
 System.
 '''
 
-import crypt
 try:
     from hashlib import sha1 as hash_constructor
 except ImportError:
     from sha import new as hash_constructor
 
+from sqlalchemy import select, and_, bindparam
 from sqlalchemy.orm import class_mapper
 from turbogears import config, identity, flash
 from turbogears.database import session
 from turbogears.util import load_class
 from turbogears.identity import set_login_attempted
 
-from fas.model import People, Configs
+from fas.model import People, Configs, Log, PeopleTable, \
+        PersonRolesTable, GroupsTable, visit_identity_table
+from fas.passwords import PasswordCheckBusy, check_password, new_hash, \
+        needs_rehash, setup as setup_password_workers
+from fas import throttle
+from fas.cache import LRUCache, FAS_CLIENT, IDENTITY, get_client, \
+        namespace_version, invalidate
 
 import pytz
 from datetime import datetime
@@ -64,6 +70,103 @@ except NameError:
 # these will be set when the provider is initialised.
 user_class = None
 visit_class = None
+identity_loader = None
+
+# Identities of visits recently seen by this process
+_identities = None
+
+def _identity_record(user, ssl=False):
+    '''Return what an identity needs to know about a user.'''
+    groups = user.approved_memberships
+    return {'user_id': user.id, 'username': user.username,
+            'status': user.status, 'ssl': ssl,
+            'groups': frozenset([g.name for g in groups]),
+            'group_ids': frozenset([g.id for g in groups])}
+
+# Everything an identity needs: one row per approved group of the user, or a
+# single row with no group if they have none
+_identity_query = select([visit_identity_table.c.user_id,
+        visit_identity_table.c.ssl, PeopleTable.c.username,
+        PeopleTable.c.status, GroupsTable.c.id.label('group_id'),
+        GroupsTable.c.name.label('group_name')],
+    visit_identity_table.c.visit_key == bindparam('visit_key'),
+    from_obj=[visit_identity_table.join(PeopleTable,
+            PeopleTable.c.id == visit_identity_table.c.user_id
+        ).outerjoin(PersonRolesTable, and_(
+            PersonRolesTable.c.person_id == PeopleTable.c.id,
+            PersonRolesTable.c.role_status == 'approved')
+        ).outerjoin(GroupsTable,
+            GroupsTable.c.id == PersonRolesTable.c.group_id)])
+
+def load_identity_from_db(visit_key):
+    '''Load the identity record of a visit with a single query.
+
+    This is the default ``identity.saprovider.loader``.  A replacement takes
+    the same argument and returns the same record.
+
+    :arg visit_key: visit_key from the user's session
+    :returns: identity record as described in :func:`load_identity_record`
+        or None if nobody is logged in with the visit
+    '''
+    rows = session.execute(_identity_query, {'visit_key': visit_key}
+            ).fetchall()
+    if not rows:
+        return None
+    groups = [(row['group_id'], row['group_name']) for row in rows
+            if row['group_id'] is not None]
+    return {'user_id': rows[0]['user_id'], 'username': rows[0]['username'],
+            'status': rows[0]['status'], 'ssl': rows[0]['ssl'],
+            'groups': frozenset([name for group_id, name in groups]),
+            'group_ids': frozenset([group_id for group_id, name in groups])}
+
+def _identity_key(visit_key):
+    return 'fas:identity:%s' % visit_key
+
+def _is_current(entry, version):
+    return isinstance(entry, tuple) and len(entry) == 2 and \
+            entry[0] == version
+
+def load_identity_record(visit_key):
+    '''Return the identity record of the user logged in with a visit.
+
+    Records are cached for ``identity.cache.ttl`` seconds, in this process
+    and in memcached, so most requests need no queries to know who is making
+    them.  They are tagged with the version of the IDENTITY namespace and
+    invalidating it makes them all out of date.  That happens when someone
+    logs out or their status or approved memberships change.  If memcached
+    is not available nothing is cached, since other processes could not
+    be told about logouts.  A record loaded while the namespace was
+    invalidated is not cached either, as it may have been read before the
+    change was committed.
+
+    :arg visit_key: visit_key from the user's session
+    :returns: dict with the user's user_id, username, status, approved
+        groups and group_ids, and whether the visit is ssl authenticated, or
+        None if nobody is logged in with the visit
+    '''
+    global _identities
+    version = namespace_version(IDENTITY)
+    if version is not None:
+        if _identities is None:
+            _identities = LRUCache(config.get('identity.cache.size', 10000),
+                    config.get('identity.cache.ttl', 60))
+        entry = _identities.get(visit_key)
+        if _is_current(entry, version):
+            return entry[1]
+        entry = get_client().get(_identity_key(visit_key))
+        if _is_current(entry, version):
+            _identities.set(visit_key, entry)
+            return entry[1]
+
+    record = identity_loader(visit_key)
+    if not record:
+        # Not logged in.  Not cached, so logging in needs no invalidation.
+        return None
+    if version is not None and namespace_version(IDENTITY) == version:
+        _identities.set(visit_key, (version, record))
+        get_client().set(_identity_key(visit_key), (version, record),
+                _identities.ttl)
+    return record
 
 def get_configs(configs_list):
     configs = {}
@@ -130,55 +233,76 @@ class SaFasIdentity(object):
             if visit_key is not None:
                 self.login(using_ssl)
 
-    def __retrieve_user(self, visit):
-        '''Attempt to load the user from the visit_key.
+    def __check_record(self, record):
+        '''Check that the user of an identity record may still be logged in.
+
+        Logs the user out if not.
 
-        :returns: a user or None
+        :returns: the identity record or None
         '''
+        if not record:
+            return None
+
         # I hope this is a safe place to double-check the SSL variables.
         # TODO: Double check my logic with this - is it unnecessary to
         # check that the username matches up?
-        if visit.ssl and cherrypy.request.headers['X-Client-Verify'] != 'SUCCESS':
+        if record['ssl'] and cherrypy.request.headers['X-Client-Verify'] != 'SUCCESS':
             self.logout()
             return None
 
-        user = user_class.query.get(visit.user_id)
-
-        # This is a hack, need to talk to Toshio abvout it.w
-        user.approved_memberships
-
-        if user.status in ('inactive', 'expired', 'admin_disabled'):
+        if record['status'] in ('inactive', 'expired', 'admin_disabled'):
             log.warning("User %(username)s has status %(status)s, logging them out." % \
-                { 'username': user.username, 'status': user.status })
+                { 'username': record['username'], 'status': record['status'] })
             self.logout()
-            user = None
-        return user
+            return None
+        return record
+
+    def _get_record(self):
+        '''Get the identity record of the user of this identity.
+
+        Everything but :attr:`user` is answered from this, so identities
+        restored from a visit only query the database if the user object
+        is needed.
+        '''
+        try:
+            return self._record
+        except AttributeError:
+            # Record hasn't been computed yet
+            pass
+        if hasattr(self, '_user'):
+            # Identity made for a user that just logged in
+            self._record = self._user and _identity_record(self._user) or None
+            return self._record
+
+        record = None
+        if self.visit_key is not None:
+            record = load_identity_record(self.visit_key)
+        if record and (not '_csrf_token' in cherrypy.request.params or
+                cherrypy.request.params['_csrf_token'] !=
+                hash_constructor(self.visit_key).hexdigest()):
+            log.info("Bad _csrf_token")
+            if '_csrf_token' in cherrypy.request.params:
+                log.info("visit: %s token: %s" % (self.visit_key,
+                    cherrypy.request.params['_csrf_token']))
+            else:
+                log.info('No _csrf_token present')
+            cherrypy.request.fas_identity_failure_reason = 'bad_csrf'
+            record = None
+        self._record = self.__check_record(record)
+        return self._record
 
     def _get_user(self):
         '''Get user instance for this identity.'''
-        visit = self.visit_link
-        if not visit:
-            self._user = None
+        try:
+            return self._user
+        except AttributeError:
+            # User hasn't already been set
+            pass
+        record = self._get_record()
+        if record:
+            self._user = user_class.query.get(record['user_id'])
         else:
-            if (not '_csrf_token' in cherrypy.request.params or
-                    cherrypy.request.params['_csrf_token'] !=
-                    hash_constructor(self.visit_key).hexdigest()):
-                log.info("Bad _csrf_token")
-                if '_csrf_token' in cherrypy.request.params:
-                    log.info("visit: %s token: %s" % (self.visit_key,
-                        cherrypy.request.params['_csrf_token']))
-                else:
-                    log.info('No _csrf_token present')
-                cherrypy.request.fas_identity_failure_reason = 'bad_csrf'
-                self._user = None
-
-            try:
-                return self._user
-            except AttributeError:
-                # User hasn't already been set
-                # Attempt to load the user. After this code executes, there
-                # *will* be a _user attribute, even if the value is None.
-                self._user = self.__retrieve_user(visit)
+            self._user = None
         return self._user
     user = property(_get_user)
 
@@ -191,10 +315,11 @@ class SaFasIdentity(object):
 
     def _get_user_name(self):
         '''Get user name of this identity.'''
-        if not self.user:
+        record = self._get_record()
+        if not record:
             return None
         ### TG: Difference: Different name for the field
-        return self.user.username
+        return record['username']
     user_name = property(_get_user_name)
 
     ### TG: Same as TG-1.0.8
@@ -208,7 +333,7 @@ class SaFasIdentity(object):
     ### TG: Same as TG-1.0.8
     def _get_anonymous(self):
         '''Return true if not logged in.'''
-        return not self.user
+        return not self._get_record()
     anonymous = property(_get_anonymous)
 
     def _get_only_token(self):
@@ -216,8 +341,8 @@ class SaFasIdentity(object):
         In one specific instance in the login template we need to know whether
         an anonymous user is just lacking a token.
         '''
-        visit = self.visit_link
-        if visit and self.__retrieve_user(visit):
+        if self.visit_key is not None and \
+                self.__check_record(load_identity_record(self.visit_key)):
             # user is valid, just the token is missing
             return True
 
@@ -238,12 +363,13 @@ class SaFasIdentity(object):
         except AttributeError:
             # Groups haven't been computed yet
             pass
-        if not self.user:
+        record = self._get_record()
+        if not record:
             self._groups = frozenset()
         else:
             ### TG: Difference.  Our model has a many::many for people:groups
             # And an association proxy that links them together
-            self._groups = frozenset([g.name for g in self.user.approved_memberships])
+            self._groups = record['groups']
         return self._groups
     groups = property(_get_groups)
 
@@ -254,12 +380,13 @@ class SaFasIdentity(object):
         except AttributeError:
             # Groups haven't been computed yet
             pass
-        if not self.user:
+        record = self._get_record()
+        if not record:
             self._group_ids = frozenset()
         else:
             ### TG: Difference.  Our model has a many::many for people:groups
             # And an association proxy that links them together
-            self._group_ids = frozenset([g.id for g in self.user.approved_memberships])
+            self._group_ids = record['group_ids']
         return self._group_ids
     group_ids = property(_get_group_ids)
 
@@ -288,6 +415,8 @@ class SaFasIdentity(object):
         if visit:
             visit.user_id = self._user.id
             visit.ssl = using_ssl
+            # Someone may still be logged in with this visit elsewhere
+            invalidate(IDENTITY)
         else:
             visit = visit_class()
             visit.visit_key = self.visit_key
@@ -302,6 +431,9 @@ class SaFasIdentity(object):
         if visit:
             session.delete(visit)
             session.flush()
+            if _identities is not None:
+                _identities.delete(self.visit_key)
+            invalidate(IDENTITY)
         # Clear the current identity
         identity.set_current_identity(SaFasIdentity())
 
@@ -314,6 +446,7 @@ class SaFasIdentityProvider(object):
 
         global user_class
         global visit_class
+        global identity_loader
 
         user_class_path = config.get("identity.saprovider.model.user", None)
         user_class = load_class(user_class_path)
@@ -321,6 +454,13 @@ class SaFasIdentityProvider(object):
         log.info(_("Loading: %(visitmod)s") % \
                 {'visitmod': visit_class_path})
         visit_class = load_class(visit_class_path)
+        loader_path = config.get('identity.saprovider.loader', None)
+        if loader_path:
+            identity_loader = load_class(loader_path)
+        else:
+            identity_loader = load_identity_from_db
+        # Fork the password workers while the process is still quiet
+        setup_password_workers()
 
     def create_provider_model(self):
         '''
@@ -352,6 +492,9 @@ class SaFasIdentityProvider(object):
             :status_admin_disabled: User is disabled and has to talk to an
                 admin before they are re-enabled.
             :bad_password: The username and password do not match.
+            :busy: Too many passwords were being checked to check this one.
+            :throttled: Too many logins as the user or from their address
+                failed lately.
 
         Arguments:
         :arg user_name: user_name we're authenticating.  If None, we'll try
@@ -367,6 +510,8 @@ class SaFasIdentityProvider(object):
         cherrypy.request.fas_provided_username = user_name
         cherrypy.request.fas_identity_failure_reason = None
         using_ssl = False
+        remote_ip = throttle.client_address(cherrypy.request.remote_addr,
+                cherrypy.request.headers.get('X-Forwarded-For'))
 
         if not user_name:
             if cherrypy.request.headers['X-Client-Verify'] == 'SUCCESS':
@@ -378,6 +523,12 @@ class SaFasIdentityProvider(object):
         if email_domain != '@' and user_name.endswith(email_domain):
             user_name = user_name[:-len(email_domain)]
 
+        # Turn away password guessing before it costs any queries or hashing
+        if not using_ssl and throttle.is_throttled(ip=remote_ip):
+            log.warning('Throttling login as %s from %s', user_name, remote_ip)
+            cherrypy.request.fas_identity_failure_reason = 'throttled'
+            return None
+
         if '@' in user_name:
             user = user_class.query.filter_by(email=user_name).first()
         else:
@@ -386,6 +537,8 @@ class SaFasIdentityProvider(object):
         if not user:
             log.warning("No such user: %s", user_name)
             cherrypy.request.fas_identity_failure_reason = 'no_user'
+            if not using_ssl:
+                throttle.login_failed(user_name, remote_ip)
             return None
 
         if user.status in ('inactive', 'expired', 'admin_disabled'):
@@ -400,10 +553,23 @@ class SaFasIdentityProvider(object):
             if 'otp' in cherrypy.request.params:
                 otp = cherrypy.request.params.pop('otp')
 
-            if not self.validate_password(user, user_name, password, otp):
+            if throttle.is_throttled(username=user.username):
+                log.warning('Throttling login as %s from %s', user.username,
+                        remote_ip)
+                cherrypy.request.fas_identity_failure_reason = 'throttled'
+                return None
+            try:
+                valid = self.validate_password(user, user_name, password, otp)
+            except PasswordCheckBusy:
+                log.warning('Too busy to check the password of %s', user_name)
+                cherrypy.request.fas_identity_failure_reason = 'busy'
+                return None
+            if not valid:
                 log.info("Passwords don't match for user: %s", user_name)
                 cherrypy.request.fas_identity_failure_reason = 'bad_password'
+                throttle.login_failed(user.username, remote_ip, user.id)
                 return None
+            throttle.login_succeeded(user.username)
             # user + password is sufficient to prove the user is in
             # control
             cherrypy.request.params['_csrf_token'] = hash_constructor(
@@ -429,16 +595,30 @@ class SaFasIdentityProvider(object):
         :otp: Given OTP (one time password)
         :returns: True if the password matches the username.  Otherwise False.
             Can return False for problems within the Account System as well.
+        :raises PasswordCheckBusy: if too many passwords are being checked
         '''
-        # crypt.crypt(stuff, '') == ''
-        # Just kill any possibility of blanks.
-        if not user.password:
-            return False
-        if not password:
-            return False
-
-        # Check if given password matches existing one
-        check_pw = (user.password == crypt.crypt(password.encode('utf-8'), user.password))
+        # Check if given password matches existing one.  Blank passwords
+        # never match.
+        check_pw = check_password(password, user.password)
+        if check_pw and needs_rehash(user.password):
+            # The password is known to be right now, so this is the time to
+            # move the user off the legacy hash
+            hashed = None
+            try:
+                hashed = new_hash(password)
+            except PasswordCheckBusy:
+                pass
+            except Exception:
+                # Keep the old hash rather than fail a good login
+                log.exception('Could not rehash the password of %s',
+                        user_name)
+            if hashed:
+                user.password = hashed
+                # The hash is part of what fasClient gets, so move the
+                # change counter on as for any other password change
+                Log(author_id=user.id, description='Password rehashed')
+                invalidate(FAS_CLIENT)
+                log.info('Rehashed the password of %s', user_name)
 
         # Check if combo login (password+otp) has been requested.
         if otp:
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Precomputed responses for fasClient.
+
+Every host asks for the same few documents, so instead of querying and
+encoding them on each request they are written once per change to a
+gzip-compressed file in ``fas_client.snapshot_dir`` and the file is sent as
+it is.  Snapshot files are named after the change counter they were built
+at, so a snapshot never has to be invalidated: a change just means the next
+request builds a new file.
+'''
+
+import os
+import errno
+import gzip
+import fcntl
+import tempfile
+
+import cherrypy
+from turbogears import config
+
+CHUNK_SIZE = 64 * 1024
+
+def snapshots_enabled():
+    '''Return True if fas_client responses should be served from snapshots.'''
+    return bool(config.get('fas_client.snapshot_dir', None))
+
+def _filename(name, counter):
+    return '%s-%d.json.gz' % (name, counter)
+
+def _build(directory, name, path, build):
+    '''Write a snapshot to a temporary file and move it into place.'''
+    level = config.get('fas_client.snapshot_compresslevel', 6)
+    fd, temp = tempfile.mkstemp('.tmp', name + '-', directory)
+    try:
+        out = os.fdopen(fd, 'wb')
+        try:
+            compressed = gzip.GzipFile(filename='', mode='wb',
+                    compresslevel=level, fileobj=out)
+            for chunk in build():
+                compressed.write(chunk)
+            compressed.close()
+        finally:
+            out.close()
+        os.chmod(temp, 0640)
+        os.rename(temp, path)
+    except:
+        os.unlink(temp)
+        raise
+
+    # Anything still reading an old snapshot keeps its open file
+    current = os.path.basename(path)
+    for filename in os.listdir(directory):
+        if filename.startswith(name + '-') and filename.endswith('.json.gz') \
+                and filename != current:
+            try:
+                os.unlink(os.path.join(directory, filename))
+            except OSError:
+                pass
+
+def _open(path):
+    try:
+        return open(path, 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def open_snapshot(name, counter, build):
+    '''Open the snapshot of a response, building it if needed.
+
+    Only one process builds a given snapshot; the others wait for it and then
+    use its result.
+
+    :arg name: Name of the response, for instance ``user_data-public``
+    :arg counter: :func:`fas.sync.change_counter` the data was read at
+    :arg build: Callable returning an iterable of the encoded response
+    :returns: file object holding the gzip-compressed response
+    '''
+    directory = config.get('fas_client.snapshot_dir')
+    path = os.path.join(directory, _filename(name, counter))
+    snapshot_file = _open(path)
+    if snapshot_file:
+        return snapshot_file
+
+    # Building a newer snapshot removes this one, and that needs the same
+    # lock, so once we hold it the file can be opened safely.
+    lock = open(os.path.join(directory, name + '.lock'), 'w')
+    try:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        # Someone else may have built it while we waited
+        snapshot_file = _open(path)
+        if not snapshot_file:
+            _build(directory, name, path, build)
+            snapshot_file = open(path, 'rb')
+    finally:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+    return snapshot_file
+
+def _read_chunks(snapshot_file, reader=None):
+    reader = reader or snapshot_file
+    try:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        snapshot_file.close()
+
+def serve_snapshot(snapshot_file):
+    '''Send a snapshot as the response body.
+
+    Clients that accept gzip get the file exactly as it is stored on disk.
+    Others get it decompressed on the fly.
+
+    :arg snapshot_file: file returned by :func:`open_snapshot`
+    :returns: an iterable the controller method should return
+    '''
+    headers = cherrypy.response.headers
+    headers['Content-Type'] = 'application/json; charset=utf-8'
+    headers['Vary'] = 'Accept-Encoding'
+    accepted = cherrypy.request.headers.get('Accept-Encoding', '')
+    encodings = [encoding.split(';', 1)[0].strip()
+            for encoding in accepted.split(',')]
+    if 'gzip' in encodings:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(
+                os.fstat(snapshot_file.fileno()).st_size)
+        return _read_chunks(snapshot_file)
+    return _read_chunks(snapshot_file,
+            gzip.GzipFile(fileobj=snapshot_file, mode='rb'))
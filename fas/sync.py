@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Incremental synchronisation of the data handed out to fasClient.
+
+Every change to a person or to a group membership writes a row to the log
+table.  A sync token remembers the highest log id a client has seen and when
+the token was issued, so the next request only has to look at the people
+mentioned in the log since then instead of dumping the whole database.
+
+The highest log id also serves as a change counter for entity tags, letting
+clients that already have the current data skip downloading it again.
+'''
+
+import time
+from datetime import datetime
+try:
+    from hashlib import sha1 as hash_constructor
+except ImportError:
+    from sha import new as hash_constructor
+
+import pytz
+import cherrypy
+from sqlalchemy import select, func, and_, or_
+from turbogears import config
+from fedora.tg.utils import request_format
+from kitchen.text.converters import to_bytes
+
+from fas.model import LogTable, GroupsTable, PersonRolesTable
+
+# Log rows get their changetime when the transaction starts but only become
+# visible when it commits.  Look back this many seconds before the token was
+# issued so slow transactions are not missed.  Sending a change twice is
+# harmless.
+CLOCK_SKEW = 300
+
+def change_counter():
+    '''Return a number that changes whenever people or memberships change.'''
+    return select([func.max(LogTable.c.id)]).execute().scalar() or 0
+
+def make_etag(*parts):
+    '''Return a strong entity tag for a response.
+
+    :arg parts: Everything the response depends on.  This should include
+        :func:`change_counter` and anything about the request or the
+        identity that changes what is sent back.
+    :returns: a quoted entity tag suitable for the ETag header
+    '''
+    digest = hash_constructor('\0'.join(to_bytes(part) for part in parts))
+    return '"%s"' % digest.hexdigest()
+
+def not_modified(etag, if_none_match=None):
+    '''Check whether the client already has the current response.
+
+    Sets the ETag header on the response.  HTTP clients send the tag back in
+    an If-None-Match header and get a bodiless 304.  Clients that cannot set
+    headers (python-fedora's) send it as the ``if_none_match`` parameter and
+    get a small json reply with ``not_modified`` set instead.
+
+    :arg etag: Tag from :func:`make_etag`
+    :kwarg if_none_match: Tag sent as a request parameter
+    :returns: None if the response has to be sent.  Otherwise the value the
+        controller method should return.
+    '''
+    cherrypy.response.headers['ETag'] = etag
+    header = cherrypy.request.headers.get('If-None-Match', '')
+    client_tags = [tag.strip() for tag in header.split(',')]
+    if etag in client_tags or '*' in client_tags:
+        cherrypy.response.status = 304
+        return ''
+    if if_none_match and if_none_match == etag:
+        if request_format() == 'json':
+            return dict(success=True, not_modified=True, etag=etag)
+        cherrypy.response.status = 304
+        return ''
+    return None
+
+def current_token():
+    '''Return a sync token for the current state of the database.
+
+    The token has to be taken *before* the data it is sent with is read so
+    that changes made while the data is being read are sent again next time.
+
+    :returns: an opaque token string
+    '''
+    return '%d.%d' % (change_counter(), int(time.time()))
+
+def parse_token(token):
+    '''Split a sync token into its parts.
+
+    :arg token: a token returned by :func:`current_token`
+    :returns: tuple of (last log id, issue time) or None if the token is not
+        valid
+    '''
+    try:
+        last_id, issued = token.split('.', 1)
+        return (int(last_id), int(issued))
+    except (AttributeError, ValueError):
+        return None
+
+def _log_range():
+    '''Return the lowest and highest log ids.'''
+    return select([func.min(LogTable.c.id), func.max(LogTable.c.id)]
+            ).execute().fetchone()
+
+def _changed_authors(since_id, since, limit):
+    '''Return up to limit distinct authors of log rows after since_id or
+    written since since.
+    '''
+    return [row[0] for row in select([LogTable.c.author_id],
+        or_(LogTable.c.id > since_id, LogTable.c.changetime >= since),
+        distinct=True).limit(limit).execute()]
+
+def _new_group_members(since):
+    '''Return the members of groups created since since.'''
+    return [row[0] for row in select([PersonRolesTable.c.person_id],
+        from_obj=[GroupsTable.join(PersonRolesTable,
+            PersonRolesTable.c.group_id == GroupsTable.c.id)]).where(
+                GroupsTable.c.creation >= since).execute()]
+
+def changed_since(token):
+    '''Find the people whose fas_client data may have changed since token.
+
+    :arg token: a token returned by :func:`current_token`
+    :returns: a set of person ids or None if the token is invalid or too old
+        for a delta to be computed.  In the latter case the caller should
+        send a full snapshot.
+    '''
+    parsed = parse_token(token)
+    if not parsed:
+        return None
+    since_id, issued = parsed
+
+    max_age = config.get('fas_client.delta_max_age', 7 * 24 * 60 * 60)
+    max_changes = config.get('fas_client.delta_max_changes', 5000)
+
+    if issued > time.time() or time.time() - issued > max_age:
+        return None
+
+    first_id, last_id = _log_range()
+    if last_id is None or since_id > last_id or first_id > since_id + 1:
+        # The log has been pruned since the token was issued (or the token
+        # belongs to another database) so we cannot know what changed.
+        return None
+
+    since = datetime.fromtimestamp(issued - CLOCK_SKEW, pytz.utc)
+    # Limit the number of people, not of log rows: one busy author must not
+    # crowd the others out of the delta.  Getting more than max_changes back
+    # means the delta would be too big anyway.
+    authors = _changed_authors(since_id, since, max_changes + 1)
+    if len(authors) > max_changes:
+        return None
+    people = set(authors)
+
+    # Creating a group gives its owner roles but the log entry is written
+    # against the person that created the group.
+    people.update(_new_group_members(since))
+
+    if len(people) > max_changes:
+        return None
+    return people
+
+def approved_roles(person_ids):
+    '''Return the approved group roles of some people.
+
+    :arg person_ids: iterable of person ids
+    :returns: dict mapping each person id to a list of [groupname, role_type]
+        pairs.  People without approved roles map to an empty list.
+    '''
+    roles = dict((person_id, []) for person_id in person_ids)
+    if not roles:
+        return roles
+    results = select([PersonRolesTable.c.person_id, GroupsTable.c.name,
+        PersonRolesTable.c.role_type],
+        from_obj=[GroupsTable.join(PersonRolesTable,
+            PersonRolesTable.c.group_id == GroupsTable.c.id)]).where(and_(
+                PersonRolesTable.c.person_id.in_(roles.keys()),
+                PersonRolesTable.c.role_status == 'approved')).execute()
+    for person_id, name, role_type in results:
+        roles[person_id].append([name, role_type])
+    return roles
@@ -0,0 +1,109 @@
+'''Stand-ins for the TurboGears config and memcached in unit tests.'''
+
+import time
+
+class Config(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+class Clock(object):
+    '''A time.time() that only moves when told to.'''
+    def __init__(self, now=1000000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class KeyRefused(Exception):
+    '''The key would be refused by python-memcache.'''
+    pass
+
+class Memcache(object):
+    '''Enough of python-memcache's Client, backed by a dict.
+
+    Keys are checked the way python-memcache checks them.  Pass down=True to
+    behave like a client whose servers are all unreachable.
+    '''
+    def __init__(self, clock=time, down=False):
+        self.clock = clock
+        self.down = down
+        # key: (value, expiry or None)
+        self.items = {}
+
+    def _check(self, key):
+        if not isinstance(key, str):
+            raise KeyRefused('Keys must be str, not %r' % type(key))
+        if len(key) > 250:
+            raise KeyRefused('Key longer than 250 characters: %s' % key)
+        for char in key:
+            if ord(char) < 33 or ord(char) == 127:
+                raise KeyRefused('Control character in key: %r' % key)
+
+    def _get(self, key):
+        self._check(key)
+        if self.down or key not in self.items:
+            return None
+        value, expiry = self.items[key]
+        if expiry is not None and expiry <= self.clock.time():
+            del self.items[key]
+            return None
+        return value
+
+    def _store(self, key, value, expires):
+        if expires:
+            self.items[key] = (value, self.clock.time() + expires)
+        else:
+            self.items[key] = (value, None)
+
+    def get(self, key):
+        return self._get(key)
+
+    def get_multi(self, keys):
+        values = {}
+        for key in keys:
+            value = self._get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value, time=0):
+        self._check(key)
+        if self.down:
+            return 0
+        self._store(key, value, time)
+        return 1
+
+    def set_multi(self, mapping, time=0):
+        failed = []
+        for key, value in mapping.iteritems():
+            if not self.set(key, value, time):
+                failed.append(key)
+        return failed
+
+    def add(self, key, value, time=0):
+        if self._get(key) is not None or self.down:
+            return 0
+        self._store(key, value, time)
+        return 1
+
+    def append(self, key, value):
+        current = self._get(key)
+        if current is None:
+            return 0
+        self.items[key] = (current + value, self.items[key][1])
+        return 1
+
+    def incr(self, key, delta=1):
+        current = self._get(key)
+        if current is None:
+            return None
+        value = int(current) + delta
+        self.items[key] = (value, self.items[key][1])
+        return value
+
+    def delete(self, key):
+        self._check(key)
+        if self.down:
+            return 0
+        self.items.pop(key, None)
+        return 1
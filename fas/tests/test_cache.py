@@ -0,0 +1,58 @@
+import os
+import unittest
+
+from fas import cache
+from fas.tests.fakes import Config, Memcache
+
+class TestValues(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (cache.config, cache.get_client)
+        self.mc = Memcache()
+        cache.config = Config({'memcached_item_size': 4096})
+        cache.get_client = lambda: self.mc
+        # Random bytes do not compress, so this takes several chunks
+        self.big = {'data': os.urandom(20000)}
+
+    def tearDown(self):
+        (cache.config, cache.get_client) = self.saved
+
+    def chunk_keys(self):
+        return sorted([key for key in self.mc.items if key != 'value'])
+
+    def test_small(self):
+        self.assertTrue(cache.set_value('value', {'a': 1}))
+        self.assertEqual(cache.get_value('value'), {'a': 1})
+        self.assertEqual(self.chunk_keys(), [])
+
+    def test_chunked(self):
+        self.assertTrue(cache.set_value('value', self.big))
+        self.assertTrue(len(self.chunk_keys()) > 1)
+        self.assertEqual(cache.get_value('value'), self.big)
+
+    def test_missing(self):
+        self.assertEqual(cache.get_value('value'), None)
+
+    def test_missing_chunk(self):
+        cache.set_value('value', self.big)
+        self.mc.delete(self.chunk_keys()[1])
+        self.assertEqual(cache.get_value('value'), None)
+
+    def test_corrupt_chunk(self):
+        cache.set_value('value', self.big)
+        key = self.chunk_keys()[1]
+        chunk, expiry = self.mc.items[key]
+        self.mc.items[key] = (chunk[:10] + chr(ord(chunk[10]) ^ 1) +
+                chunk[11:], expiry)
+        self.assertEqual(cache.get_value('value'), None)
+
+    def test_replaced(self):
+        cache.set_value('value', self.big)
+        new = {'data': os.urandom(20000)}
+        cache.set_value('value', new)
+        self.assertEqual(cache.get_value('value'), new)
+
+    def test_memcached_down(self):
+        self.mc.down = True
+        self.assertFalse(cache.set_value('value', self.big))
+        self.assertEqual(cache.get_value('value'), None)
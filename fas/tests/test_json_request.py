@@ -0,0 +1,59 @@
+import base64
+import unittest
+
+from fas.json_request import _host_access, _host_groups, _encode_ids
+
+def group(id, group_type, users=(), sponsors=(), administrators=()):
+    return {'id': id, 'type': group_type, 'users': list(users),
+            'sponsors': list(sponsors), 'administrators': list(administrators)}
+
+GROUPS = {
+    'cla_done': group(1, 'cla', users=[1, 2, 3, 4]),
+    'sysadmin': group(2, 'tracking', users=[1], administrators=[5]),
+    'git-foo': group(3, 'git', users=[2], sponsors=[6]),
+    'empty': group(4, 'tracking'),
+}
+
+class TestHostAccess(unittest.TestCase):
+
+    def test_groups(self):
+        access, unknown = _host_access(GROUPS, ['sysadmin'], ['git-foo'],
+                'cla_done')
+        self.assertEqual(access, {1: True, 5: True, 2: False, 6: False})
+        self.assertEqual(unknown, [])
+
+    def test_full_account_wins(self):
+        access, unknown = _host_access(GROUPS, ['@git'], ['git-foo'],
+                'cla_done')
+        self.assertEqual(access, {2: True, 6: True})
+
+    def test_all(self):
+        # CLA and one other group
+        access, unknown = _host_access(GROUPS, [], ['@all'], 'cla_done')
+        self.assertEqual(access, {1: False, 2: False})
+
+    def test_unknown(self):
+        access, unknown = _host_access(GROUPS, ['nosuch', '@svn', 'empty'],
+                ['@all'], 'cla_nosuch')
+        self.assertEqual(access, {})
+        self.assertEqual(unknown, ['nosuch', '@svn', 'cla_nosuch'])
+
+    def test_host_groups(self):
+        groups = _host_groups(GROUPS, set([1, 6]))
+        # Groups without members on the host still go in /etc/group
+        self.assertEqual(sorted(groups),
+                ['cla_done', 'empty', 'git-foo', 'sysadmin'])
+        self.assertEqual(groups['empty'], group(4, 'tracking'))
+        self.assertEqual(groups['sysadmin']['users'], [1])
+        self.assertEqual(groups['sysadmin']['administrators'], [])
+        self.assertEqual(groups['git-foo']['sponsors'], [6])
+
+class TestEncodeIds(unittest.TestCase):
+
+    def test_encode(self):
+        # 5, then +1, then +995 (two bytes: 0x63|0x80, 0x07)
+        self.assertEqual(base64.b64decode(_encode_ids([1001, 5, 6])),
+                '\x05\x01\xe3\x07')
+
+    def test_empty(self):
+        self.assertEqual(_encode_ids([]), '')
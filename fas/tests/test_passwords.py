@@ -0,0 +1,107 @@
+import threading
+import unittest
+import multiprocessing
+
+from fas import passwords
+from fas.tests.fakes import Config, Clock
+
+class Result(object):
+    def __init__(self, value=None, hung=False):
+        self.value = value
+        self.hung = hung
+
+    def get(self, timeout=None):
+        if self.hung:
+            raise multiprocessing.TimeoutError()
+        return self.value
+
+class Pool(object):
+    '''Runs tasks straight away, or never calls back for them if hung, as
+    when a worker dies.'''
+    def __init__(self):
+        self.hung = False
+        self.callbacks = []
+
+    def apply_async(self, func, args, callback):
+        if self.hung:
+            self.callbacks.append(callback)
+            return Result(hung=True)
+        value = func(*args)
+        callback(value)
+        return Result(value)
+
+class PasswordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (passwords.config, passwords.time, passwords._pool,
+                passwords._slots)
+        self.clock = Clock()
+        passwords.config = Config({'password.queue_size': 2,
+            'password.hard_timeout': 60})
+        passwords.time = self.clock
+        passwords._pool = None
+        passwords._slots = threading.BoundedSemaphore(2)
+        passwords._outstanding.clear()
+
+    def tearDown(self):
+        (passwords.config, passwords.time, passwords._pool,
+                passwords._slots) = self.saved
+
+class TestHashing(PasswordsTest):
+
+    def test_round_trip(self):
+        hashed = passwords.new_hash(u'secret')
+        self.assertTrue(hashed.startswith('$6$'))
+        self.assertTrue(passwords.check_password(u'secret', hashed))
+        self.assertFalse(passwords.check_password(u'Secret', hashed))
+        self.assertFalse(passwords.needs_rehash(hashed))
+
+    def test_blank(self):
+        self.assertFalse(passwords.check_password(u'', ''))
+        self.assertFalse(passwords.check_password(u'secret', ''))
+
+    def test_legacy(self):
+        self.assertTrue(passwords.needs_rehash('$1$abcdefgh$xxxxxxxxxxxxxx'))
+        passwords.config['password.rehash'] = False
+        self.assertFalse(passwords.needs_rehash('$1$abcdefgh$xxxxxxxxxxxxxx'))
+
+class TestQueue(PasswordsTest):
+
+    def test_full(self):
+        passwords._slots.acquire()
+        passwords._slots.acquire()
+        self.assertRaises(passwords.PasswordCheckBusy, passwords.new_hash,
+                u'secret')
+
+    def test_pool(self):
+        passwords._pool = Pool()
+        hashed = passwords.new_hash(u'secret')
+        self.assertTrue(passwords.check_password(u'secret', hashed))
+        self.assertEqual(passwords._outstanding, {})
+
+    def test_dead_workers(self):
+        passwords._pool = Pool()
+        passwords._pool.hung = True
+        for i in range(2):
+            self.assertRaises(passwords.PasswordCheckBusy,
+                    passwords.new_hash, u'secret')
+        # Both slots are taken by tasks that will never finish
+        passwords._pool.hung = False
+        self.assertRaises(passwords.PasswordCheckBusy, passwords.new_hash,
+                u'secret')
+        self.clock.now += 61
+        hashed = passwords.new_hash(u'secret')
+        self.assertTrue(passwords.check_password(u'secret', hashed))
+
+    def test_late_callback(self):
+        passwords._pool = Pool()
+        passwords._pool.hung = True
+        self.assertRaises(passwords.PasswordCheckBusy, passwords.new_hash,
+                u'secret')
+        self.clock.now += 61
+        passwords._reclaim()
+        # The task finished after all: its slot was given back already
+        passwords._pool.callbacks[0]('hash')
+        passwords._slots.acquire(False)
+        passwords._slots.acquire(False)
+        self.assertFalse(passwords._slots.acquire(False))
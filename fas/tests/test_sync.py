@@ -0,0 +1,56 @@
+import time
+import unittest
+
+from fas import sync
+
+class Config(dict):
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+class TestChangedSince(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (sync.config, sync._log_range, sync._changed_authors,
+                sync._new_group_members)
+        sync.config = Config({'fas_client.delta_max_changes': 3})
+        sync._log_range = lambda: (1, 100)
+        sync._new_group_members = lambda since: []
+        self.token = '50.%d' % int(time.time())
+
+    def tearDown(self):
+        (sync.config, sync._log_range, sync._changed_authors,
+                sync._new_group_members) = self.saved
+
+    def authors(self, *person_ids):
+        def changed_authors(since_id, since, limit):
+            self.assertEqual(since_id, 50)
+            return list(person_ids)[:limit]
+        sync._changed_authors = changed_authors
+
+    def test_delta(self):
+        self.authors(1, 2)
+        sync._new_group_members = lambda since: [2, 7]
+        self.assertEqual(sync.changed_since(self.token), set([1, 2, 7]))
+
+    def test_at_limit(self):
+        self.authors(1, 2, 3)
+        self.assertEqual(sync.changed_since(self.token), set([1, 2, 3]))
+
+    def test_over_limit(self):
+        # More authors than the query may return means a full snapshot, not
+        # a delta missing some of them
+        self.authors(1, 2, 3, 4, 5)
+        self.assertEqual(sync.changed_since(self.token), None)
+
+    def test_over_limit_with_new_members(self):
+        self.authors(1, 2, 3)
+        sync._new_group_members = lambda since: [4]
+        self.assertEqual(sync.changed_since(self.token), None)
+
+    def test_pruned_log(self):
+        self.authors(1)
+        sync._log_range = lambda: (60, 100)
+        self.assertEqual(sync.changed_since(self.token), None)
+
+    def test_bad_token(self):
+        self.assertEqual(sync.changed_since('junk'), None)
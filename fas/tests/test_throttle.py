@@ -0,0 +1,172 @@
+import unittest
+
+from sqlalchemy.exc import IntegrityError
+
+from fas import throttle
+from fas.tests.fakes import Config, Clock, Memcache
+
+class ThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (throttle.config, throttle.get_client, throttle.time,
+                throttle._recent_failures, throttle._existing_rows,
+                throttle._insert_rows, throttle._update_rows)
+        self.clock = Clock()
+        self.mc = Memcache(self.clock)
+        throttle.config = Config({'throttle.window': 900,
+            'throttle.max_user_failures': 3,
+            'throttle.max_ip_failures': 5,
+            'throttle.by_ip': True,
+            'throttle.trusted_proxies': ['10.0.0.10', '10.0.0.11']})
+        throttle.get_client = lambda: self.mc
+        throttle.time = self.clock
+        throttle._recent_failures = lambda usernames, since: []
+        self.existing = set()
+        self.inserted = []
+        self.updated = []
+        throttle._existing_rows = lambda person_ids: self.existing
+        throttle._insert_rows = self.inserted.append
+        throttle._update_rows = self.updated.extend
+        throttle._local_counts.clear()
+        throttle._local_index.clear()
+        throttle._pending.clear()
+        throttle._pending_since = None
+
+    def tearDown(self):
+        (throttle.config, throttle.get_client, throttle.time,
+                throttle._recent_failures, throttle._existing_rows,
+                throttle._insert_rows, throttle._update_rows) = self.saved
+
+    def fail_logins(self, username, ip, times, person_id=None):
+        for i in xrange(times):
+            throttle.login_failed(username, ip, person_id)
+
+class TestKeys(ThrottleTest):
+
+    def test_long_username(self):
+        username = u'x' * 300
+        self.fail_logins(username, '10.0.0.1', 3)
+        self.assertTrue(throttle.is_throttled(username=username))
+        self.assertEqual(throttle.throttled()['users'].keys(),
+                [username[:throttle.MAX_INDEXED_NAME]])
+
+    def test_odd_characters(self):
+        username = u'bad name\n\xe9'
+        self.fail_logins(username, '10.0.0.1', 3)
+        self.assertTrue(throttle.is_throttled(username=username))
+        self.assertEqual(throttle.throttled()['users'].keys(), [username])
+
+class TestWindow(ThrottleTest):
+
+    def test_limit(self):
+        self.fail_logins(u'alice', '192.0.2.1', 2)
+        self.assertFalse(throttle.is_throttled(username=u'alice'))
+        self.fail_logins(u'alice', '192.0.2.1', 1)
+        self.assertTrue(throttle.is_throttled(username=u'alice'))
+        self.assertFalse(throttle.is_throttled(username=u'bob'))
+
+    def test_window_ends(self):
+        self.fail_logins(u'alice', '192.0.2.1', 3)
+        self.clock.now += 899
+        self.assertTrue(throttle.is_throttled(username=u'alice'))
+        self.clock.now += 2
+        self.assertFalse(throttle.is_throttled(username=u'alice'))
+        self.assertEqual(throttle.throttled()['users'], {})
+
+    def test_window_starts_with_first_failure(self):
+        self.fail_logins(u'alice', '192.0.2.1', 2)
+        self.clock.now += 901
+        self.fail_logins(u'alice', '192.0.2.1', 2)
+        self.assertFalse(throttle.is_throttled(username=u'alice'))
+
+    def test_success(self):
+        self.fail_logins(u'alice', '192.0.2.1', 2)
+        throttle.login_succeeded(u'alice')
+        self.fail_logins(u'alice', '192.0.2.1', 1)
+        self.assertFalse(throttle.is_throttled(username=u'alice'))
+
+    def test_index_rollover(self):
+        # 50 seconds before the index moves on to the next bucket
+        self.clock.now = (throttle._bucket() + 1) * 900 - 50
+        self.fail_logins(u'alice', '192.0.2.1', 3)
+        self.clock.now += 100
+        self.fail_logins(u'bob', '192.0.2.2', 3)
+        self.assertEqual(sorted(throttle.throttled()['users']),
+                [u'alice', u'bob'])
+        self.clock.now += 860
+        self.assertEqual(sorted(throttle.throttled()['users']), [u'bob'])
+
+    def test_memcached_down(self):
+        self.mc.down = True
+        self.fail_logins(u'alice', '192.0.2.1', 3)
+        self.assertTrue(throttle.is_throttled(username=u'alice'))
+        self.assertEqual(throttle.throttled()['users'].keys(), [u'alice'])
+        self.clock.now += 901
+        self.assertFalse(throttle.is_throttled(username=u'alice'))
+        self.assertEqual(throttle.throttled()['users'], {})
+
+class TestFlush(ThrottleTest):
+
+    def test_batch(self):
+        throttle.config['throttle.batch_size'] = 2
+        self.fail_logins(u'alice', '192.0.2.1', 2, 1)
+        self.assertEqual(self.inserted, [])
+        self.fail_logins(u'bob', '192.0.2.1', 1, 2)
+        self.assertEqual(len(self.inserted[0]), 2)
+        self.assertEqual(throttle._pending, {})
+
+    def test_unknown_users(self):
+        self.fail_logins(u'nobody', '192.0.2.1', 1)
+        throttle.flush()
+        self.assertEqual(self.inserted, [])
+
+    def test_update_and_insert(self):
+        self.existing.add((1, '192.0.2.1'))
+        self.fail_logins(u'alice', '192.0.2.1', 1, 1)
+        self.fail_logins(u'bob', '192.0.2.2', 1, 2)
+        throttle.flush()
+        self.assertEqual([(row['b_person_id'], row['b_ip'])
+            for row in self.updated], [(1, '192.0.2.1')])
+        self.assertEqual([(row['person_id'], row['ip'])
+            for row in self.inserted[0]], [(2, '192.0.2.2')])
+
+    def test_conflict(self):
+        # Another process inserted bob's row after we looked
+        def insert_rows(rows):
+            if isinstance(rows, list) or rows['person_id'] == 2:
+                raise IntegrityError('INSERT', rows, None)
+            self.inserted.append(rows)
+        throttle._insert_rows = insert_rows
+        self.fail_logins(u'bob', '192.0.2.2', 1, 2)
+        self.fail_logins(u'carol', '192.0.2.3', 1, 3)
+        throttle.flush()
+        self.assertEqual([row['person_id'] for row in self.inserted], [3])
+        self.assertEqual([row['b_person_id'] for row in self.updated], [2])
+
+class TestAddress(ThrottleTest):
+
+    def test_direct(self):
+        self.assertEqual(throttle.client_address('192.0.2.1', '10.9.9.9'),
+                '192.0.2.1')
+
+    def test_behind_proxies(self):
+        self.assertEqual(throttle.client_address('10.0.0.10',
+            '203.0.113.5, 192.0.2.1, 10.0.0.11'), '192.0.2.1')
+
+    def test_only_proxies(self):
+        self.assertEqual(throttle.client_address('10.0.0.10', '10.0.0.11'),
+                None)
+        self.assertEqual(throttle.client_address('10.0.0.10'), None)
+
+    def test_by_ip(self):
+        self.fail_logins(u'a', '192.0.2.1', 2)
+        self.fail_logins(u'b', '192.0.2.1', 2)
+        self.fail_logins(u'c', '192.0.2.1', 1)
+        self.assertTrue(throttle.is_throttled(ip='192.0.2.1'))
+
+    def test_not_by_ip(self):
+        throttle.config['throttle.by_ip'] = False
+        self.fail_logins(u'a', '192.0.2.1', 2)
+        self.fail_logins(u'b', '192.0.2.1', 2)
+        self.fail_logins(u'c', '192.0.2.1', 1)
+        self.assertFalse(throttle.is_throttled(ip='192.0.2.1'))
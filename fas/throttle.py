@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright © 2014 Red Hat, Inc.
+#
+# This copyrighted material is made available to anyone wishing to use, modify,
+# copy, or redistribute it subject to the terms and conditions of the GNU
+# General Public License v.2.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY expressed or implied, including the
+# implied warranties of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.  You should have
+# received a copy of the GNU General Public License along with this program;
+# if not, write to the Free Software Foundation, Inc., 51 Franklin Street,
+# Fifth Floor, Boston, MA 02110-1301, USA. Any Red Hat trademarks that are
+# incorporated in the source code or documentation are not subject to the GNU
+# General Public License and may only be used or replicated with the express
+# permission of Red Hat, Inc.
+#
+'''
+Login throttling.
+
+Failed logins are counted per username, and per IP address if
+``throttle.by_ip`` is set, in memcached, or in the process itself while
+memcached is unavailable.  Once either count
+reaches its limit, further logins are turned down without checking the
+password until ``throttle.window`` seconds after the first failure.
+Usernames and addresses that reach their limit are noted in an index in
+memcached, which is where :func:`throttled` finds them.
+
+Failures of people who exist are also recorded in the requests table, one
+row per person, server and IP with the time of the last failure.  The rows
+are written a batch at a time.  Failures for usernames that do not exist
+are only counted.
+'''
+
+import time
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+try:
+    from hashlib import sha1 as hash_constructor
+except ImportError:
+    from sha import new as hash_constructor
+
+import pytz
+from sqlalchemy import select, and_, bindparam
+from sqlalchemy.exc import IntegrityError
+from turbogears import config
+
+from fas.model import PeopleTable, RequestsTable
+from fas.cache import get_client
+
+log = logging.getLogger('fas.throttle')
+
+# requests.action of failed logins
+ACTION = 'login_failed'
+
+_hostname = socket.gethostname()
+
+# Longest name kept in the index.  Usernames that do not exist can be as
+# long as an attacker likes.
+MAX_INDEXED_NAME = 256
+
+# (person_id, ip): time of the last failure not yet written to the database
+_pending = {}
+_pending_since = None
+_pending_lock = threading.Lock()
+
+# Counts kept here while memcached is unavailable, key: [count, expiry]
+_local_counts = {}
+# Index entries kept here while memcached is unavailable, entry: expiry
+_local_index = {}
+_local_lock = threading.Lock()
+
+def enabled():
+    return config.get('throttle.enabled', True)
+
+def _window():
+    return config.get('throttle.window', 900)
+
+def _by_ip():
+    return config.get('throttle.by_ip', False)
+
+def _limits():
+    return {'user': config.get('throttle.max_user_failures', 10),
+            'ip': config.get('throttle.max_ip_failures', 100)}
+
+def _digest(name):
+    return hash_constructor(name.encode('utf-8')).hexdigest()
+
+def _digest_key(kind, digest):
+    return 'fas:throttle:%s:%s' % (kind, digest)
+
+def _key(kind, name):
+    # Names can be any length and hold any character, neither of which
+    # memcached keys may, so key on a digest
+    return _digest_key(kind, _digest(name))
+
+def _entry(kind, name):
+    return '%s:%s:%s' % (kind, _digest(name),
+            name[:MAX_INDEXED_NAME].encode('utf-8').encode('hex'))
+
+def _parse_entry(entry):
+    '''Return the (kind, digest, name) of an index entry.'''
+    kind, digest, name = entry.split(':', 2)
+    return kind, digest, name.decode('hex').decode('utf-8')
+
+def _index_key(bucket):
+    return 'fas:throttle:index:%d' % bucket
+
+def _bucket():
+    return int(time.time() / _window())
+
+def _add_to_index(kind, name):
+    '''Note that logins as or from name are throttled.
+
+    The index is split into buckets of one window.  Entries are appended to
+    the current one, which memcached does atomically, so concurrent
+    processes do not lose each other's entries.  A throttle lasts at most a
+    window, so the current and the previous bucket hold all that are still
+    in force.
+    '''
+    entry = _entry(kind, name)
+    mc = get_client()
+    key = _index_key(_bucket())
+    mc.add(key, '', time=2 * _window())
+    if not mc.append(key, entry + '\n'):
+        _local_lock.acquire()
+        try:
+            _local_index[entry] = time.time() + _window()
+        finally:
+            _local_lock.release()
+
+def _indexed():
+    '''Return the (kind, digest, name) of every entry in the index.'''
+    bucket = _bucket()
+    entries = set()
+    for value in get_client().get_multi([_index_key(bucket - 1),
+            _index_key(bucket)]).itervalues():
+        entries.update(value.split())
+    now = time.time()
+    _local_lock.acquire()
+    try:
+        for entry, expiry in _local_index.items():
+            if expiry < now:
+                del _local_index[entry]
+            else:
+                entries.add(entry)
+    finally:
+        _local_lock.release()
+    return [_parse_entry(entry) for entry in entries]
+
+def _count_locally(key, increment):
+    now = time.time()
+    _local_lock.acquire()
+    try:
+        entry = _local_counts.get(key)
+        if entry is None or entry[1] < now:
+            if not increment:
+                _local_counts.pop(key, None)
+                return 0
+            entry = _local_counts[key] = [0, now + _window()]
+        entry[0] += increment
+        return entry[0]
+    finally:
+        _local_lock.release()
+
+def _add_failure(key):
+    '''Count one more failure under key and return the new count.'''
+    mc = get_client()
+    count = mc.incr(key)
+    if count is None:
+        # The window starts with the first failure
+        if mc.add(key, 1, time=_window()):
+            count = 1
+        else:
+            # Somebody else added it, or memcached is down
+            count = mc.incr(key)
+    if count is None:
+        return _count_locally(key, 1)
+    return count
+
+def _failures(keys):
+    '''Return the number of failures counted under each of keys.'''
+    counts = get_client().get_multi(keys)
+    for key in keys:
+        counts[key] = max(int(counts.get(key) or 0), _count_locally(key, 0))
+    return counts
+
+def client_address(remote_addr, forwarded_for=None):
+    '''Return the address a request comes from.
+
+    Behind a proxy, every request comes from the proxy's address.  When
+    remote_addr is one of ``throttle.trusted_proxies``, the address is taken
+    from the X-Forwarded-For header instead, skipping the trusted proxies
+    from the right.  Addresses left of the first untrusted one could have
+    been made up by the client.
+
+    :arg remote_addr: address of the other end of the connection
+    :kwarg forwarded_for: value of the X-Forwarded-For header, if any
+    :returns: the client address, or None if only trusted proxies are known
+    '''
+    proxies = config.get('throttle.trusted_proxies', [])
+    if remote_addr not in proxies:
+        return remote_addr
+    hops = [hop.strip() for hop in (forwarded_for or '').split(',')]
+    hops = [hop for hop in hops if hop]
+    while hops:
+        address = hops.pop()
+        if address not in proxies:
+            return address
+    return None
+
+def is_throttled(username=None, ip=None):
+    '''Tell whether logins as username or from ip are turned down.
+
+    :kwarg username: username that is logging in
+    :kwarg ip: address the login comes from
+    :returns: True if either has failed too often lately
+    '''
+    if not enabled():
+        return False
+    limits = _limits()
+    keys = {}
+    if username:
+        keys[_key('user', username)] = limits['user']
+    if ip and _by_ip():
+        keys[_key('ip', ip)] = limits['ip']
+    if not keys:
+        return False
+    counts = _failures(keys.keys())
+    for key, limit in keys.iteritems():
+        if counts[key] >= limit:
+            return True
+    return False
+
+def login_failed(username, ip, person_id=None):
+    '''Record a login that failed for lack of the right password.
+
+    :arg username: username that tried to log in
+    :arg ip: address the login came from
+    :kwarg person_id: id of the person if username exists
+    '''
+    global _pending_since
+    if not enabled():
+        return
+    if _add_failure(_key('user', username)) == _limits()['user']:
+        log.warning('Throttling logins as %s', username)
+        _add_to_index('user', username)
+    if ip and _by_ip() and _add_failure(_key('ip', ip)) == _limits()['ip']:
+        log.warning('Throttling logins from %s', ip)
+        _add_to_index('ip', ip)
+
+    if person_id is None:
+        return
+    _pending_lock.acquire()
+    try:
+        _pending[(person_id, ip or '')] = datetime.now(pytz.utc)
+        if _pending_since is None:
+            _pending_since = time.time()
+        due = len(_pending) >= config.get('throttle.batch_size', 50) or \
+                time.time() - _pending_since >= \
+                config.get('throttle.flush_interval', 30)
+    finally:
+        _pending_lock.release()
+    if due:
+        flush()
+
+def login_succeeded(username):
+    '''Forget the failed logins of username.
+
+    Failures from the address are kept, so one good account does not open
+    the way for guessing the passwords of others.
+    '''
+    if not enabled():
+        return
+    key = _key('user', username)
+    get_client().delete(key)
+    _local_lock.acquire()
+    try:
+        _local_counts.pop(key, None)
+    finally:
+        _local_lock.release()
+
+def _update_rows(updates):
+    RequestsTable.update(and_(
+            RequestsTable.c.person_id == bindparam('b_person_id'),
+            RequestsTable.c.hostname == _hostname,
+            RequestsTable.c.ip == bindparam('b_ip'),
+            RequestsTable.c.action == ACTION),
+        values={RequestsTable.c.last_request: bindparam('b_last_request')}
+        ).execute(updates)
+
+def _update_params(row):
+    return {'b_person_id': row['person_id'], 'b_ip': row['ip'],
+            'b_last_request': row['last_request']}
+
+def _existing_rows(person_ids):
+    '''Return the (person_id, ip) of the rows this server has for failed
+    logins of person_ids.
+    '''
+    rows = select([RequestsTable.c.person_id, RequestsTable.c.ip],
+            and_(RequestsTable.c.hostname == _hostname,
+                RequestsTable.c.action == ACTION,
+                RequestsTable.c.person_id.in_(list(person_ids)))).execute()
+    return set([(row[0], row[1]) for row in rows])
+
+def _insert_rows(rows):
+    RequestsTable.insert().execute(rows)
+
+def flush():
+    '''Write the failures recorded so far to the requests table.
+
+    Rows that exist for the person, server and IP are updated in one
+    statement and the others inserted in another.  If another process
+    inserted some of the same rows in the meantime, the insert is retried
+    a row at a time, updating the rows that now exist.
+    '''
+    global _pending, _pending_since
+    _pending_lock.acquire()
+    try:
+        failures = _pending
+        _pending = {}
+        _pending_since = None
+    finally:
+        _pending_lock.release()
+    if not failures:
+        return
+
+    existing = _existing_rows(set([person_id for person_id, ip in failures]))
+
+    updates = []
+    inserts = []
+    for (person_id, ip), when in failures.iteritems():
+        row = {'person_id': person_id, 'hostname': _hostname, 'ip': ip,
+            'action': ACTION, 'last_request': when, 'approved': False}
+        if (person_id, ip) in existing:
+            updates.append(_update_params(row))
+        else:
+            inserts.append(row)
+    if updates:
+        _update_rows(updates)
+    if not inserts:
+        return
+    try:
+        _insert_rows(inserts)
+    except IntegrityError:
+        # The whole statement was rolled back, so go through the rows one
+        # by one
+        for row in inserts:
+            try:
+                _insert_rows(row)
+            except IntegrityError:
+                _update_rows([_update_params(row)])
+
+def _recent_failures(usernames, since):
+    '''Return the (username, ip, last_request) of requests rows for failed
+    logins as usernames since since.
+    '''
+    return select([PeopleTable.c.username, RequestsTable.c.ip,
+            RequestsTable.c.last_request],
+        and_(RequestsTable.c.action == ACTION,
+            RequestsTable.c.last_request >= since,
+            PeopleTable.c.username.in_(usernames)),
+        from_obj=[RequestsTable.join(PeopleTable,
+            PeopleTable.c.id == RequestsTable.c.person_id)]).execute()
+
+def throttled():
+    '''List the usernames and addresses whose logins are turned down.
+
+    :returns: dict with ``users``, mapping usernames to their failure count
+        and, for people who exist, the time of their last failure and the
+        addresses it came from, and ``ips``, mapping addresses to their
+        failure count
+    '''
+    flush()
+    limits = _limits()
+    indexed = _indexed()
+    counts = _failures([_digest_key(kind, digest)
+        for kind, digest, name in indexed])
+    users = {}
+    ips = {}
+    for kind, digest, name in indexed:
+        count = counts[_digest_key(kind, digest)]
+        if count < limits[kind]:
+            # The window ran out or the user logged in since
+            continue
+        if kind == 'user':
+            users[name] = {'failures': count, 'last_failure': None, 'ips': []}
+        else:
+            ips[name] = count
+    if not users:
+        return {'users': users, 'ips': ips}
+
+    since = datetime.now(pytz.utc) - timedelta(seconds=_window())
+    for username, ip, last_request in _recent_failures(users.keys(), since):
+        user = users[username]
+        user['last_failure'] = max(user['last_failure'], last_request)
+        if ip and ip not in user['ips']:
+            user['ips'].append(ip)
+    for user in users.itervalues():
+        user['ips'].sort()
+    return {'users': users, 'ips': ips}
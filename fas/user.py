@@ -51,11 +51,6 @@ import string
 import subprocess
 from OpenSSL import crypto
 
-if config.get('use_openssl_rand_bytes', False):
-    from OpenSSL.rand import bytes as rand_bytes
-else:
-    from os import urandom as rand_bytes
-
 import pytz
 from datetime import datetime
 import time
@@ -71,6 +66,8 @@ import fas.fedmsgshim
 import fas
 from fas.model import PeopleTable, PersonRolesTable, GroupsTable
 from fas.model import People, PersonRoles, Groups, Log
+from fas.cache import invalidate, FAS_CLIENT, IDENTITY
+from fas.passwords import random_string, make_salt
 from fas import openssl_fas
 from fas.auth import (
 	is_admin,
@@ -174,43 +171,15 @@ def generate_password(password=None, length=16):
     '''
     secret = {} # contains both hash and password
 
-    # From crypt(3) manpage.
-    salt_charset = string.ascii_letters + string.digits + './'
-    salt = random_string(salt_charset, 16)
-    hash_id = '6' # SHA-512
-    salt_str = '$' + hash_id + '$' + salt
-
     if password is None:
         password_charset = string.ascii_letters + string.digits
         password = random_string(password_charset, length)
 
-    secret['hash'] = crypt.crypt(password.encode('utf-8'), salt_str)
+    secret['hash'] = crypt.crypt(password.encode('utf-8'), make_salt())
     secret['pass'] = password
 
     return secret
 
-def random_string(charset, length):
-    '''Generates a random string for password and salts.
-
-    This use a pseudo-random number generator suitable for cryptographic
-    use, such as /dev/urandom or (better) OpenSSL's RAND_bytes.
-
-    :arg length: Length of salt to be generated
-    :returns: String of salt
-    '''
-    s = ''
-
-    while length > 0:
-        r = rand_bytes(length)
-        for c in r:
-            # Discard all bytes that aren't in the charset.  This is the
-            # simplest way to ensure that the function is not biased.
-            if c in charset:
-                s += c
-                length -= 1
-
-    return s
-
 class User(controllers.Controller):
     ''' Our base User controller for user based operations '''
     # Regex to tell if something looks like a crypted password
@@ -372,6 +341,7 @@ class User(controllers.Controller):
                      'new': status})
                 target.status = status
                 target.status_change = datetime.now(pytz.utc)
+                invalidate(FAS_CLIENT, IDENTITY)
                 changed.append('status')
 
             if target.email != email:
@@ -439,6 +409,10 @@ class User(controllers.Controller):
             turbogears.redirect("/user/edit/%s" % target.username)
             return dict()
         else:
+            if changed:
+                # fasClient picks up account changes from the log
+                Log(author_id=target.id, description='%s edited %s: %s' %
+                    (person.username, target.username, ', '.join(changed)))
             change_subject = _('Fedora Account Data Update %s') % \
                 target.username
             change_text = _('''
@@ -503,8 +477,15 @@ If the above information is incorrect, please log in and fix it:
         (modo, can_update) = is_modo(user)
         if (modo and can_update) or is_admin(user):
             try:
+                Log(author_id=target.id, description=
+                    '%(person)s\'s status changed from %(old)s to %(new)s by %(user)s' % \
+                    {'person': target.username,
+                     'old': target.status,
+                     'new': status,
+                     'user': user})
                 target.status = status
                 target.status_change = datetime.now(pytz.utc)
+                invalidate(FAS_CLIENT, IDENTITY)
             except TypeError, error:
                 turbogears.flash(_('Account status could not be changed: %s')
                     % error)
@@ -1395,6 +1376,7 @@ To change your password (or to cancel the request), please visit
 
             person.status = 'active'
             person.status_change = datetime.now(pytz.utc)
+            invalidate(FAS_CLIENT, IDENTITY)
             changed.append('status')
 
         # Log the change
@@ -1579,6 +1561,7 @@ automatically revoked, and should stop working within the hour.
         username = identity.current.user_name
         person  = People.by_username(username)
         person.ssh_key = ''
+        Log(author_id=person.id, description='SSH key removed')
         fas.fedmsgshim.send_message(topic="user.update", msg={
             'agent': person.username,
             'user': person.username,
@@ -12,6 +12,7 @@ turbogears.update_config(configfile="/etc/account-expiry.cfg")
 import turbomail
 from turbogears.database import session
 from fas.model import *
+from fas.cache import invalidate, FAS_CLIENT, IDENTITY
 from email.Message import Message
 import smtplib
 
@@ -44,6 +45,7 @@ if __name__ == '__main__':
     
     people = People.query.all()
     whitelist = config.get('whitelist').split(',')
+    expired = False
     
     for person in people:
         if person.id < 10000 or person.username in whitelist:
@@ -55,6 +57,10 @@ if __name__ == '__main__':
         diff = now - person.last_seen
         if diff > MAX_AGE:
             person.status = 'inactive'
+            person.status_change = now
+            expired = True
+            Log(author_id=person.id, description='%s\'s status changed from active to inactive by account-expiry' %
+                person.username)
             send_email(config.get('accounts_email'), person.email, 'Fedora Account Expiry', \
             '''Your Fedora Account password has expired, so your account has been
 disabled.  To reenable your account, please request a password reset at
@@ -75,4 +81,5 @@ possible to prevent your account from being disabled.
 ''')
     
     session.flush()
-
+    if expired:
+        invalidate(FAS_CLIENT, IDENTITY)